@@ -6,9 +6,10 @@ import time
 # Add current dir to path
 sys.path.append(os.getcwd())
 
-from db import init_db, get_session, Book, Chapter
-from sqlalchemy import select
-from modules import outline, chapter, book_compiler
+from db import init_db, get_session, SessionFactory, Book, Chapter
+from modules import outline, chapter, book_compiler, library, notifications, budget, duplicates, candidates, changes, state_machine
+import llm_client
+import metrics
 
 # Page Config
 st.set_page_config(page_title="AI Book Generator", layout="wide")
@@ -16,11 +17,107 @@ st.set_page_config(page_title="AI Book Generator", layout="wide")
 # Initialize DB
 if 'db_initialized' not in st.session_state:
     init_db()
+    with get_session() as session:
+        duplicates.backfill(session) # Chapters approved before the duplicate index existed
     st.session_state.db_initialized = True
 
 def get_db():
     return get_session()
 
+def section_rewrite_form(session, ch, key: str):
+    """Rewrite only part of a chapter (paragraph range or a quoted passage)."""
+    with st.expander("✂️ Rewrite a Section"):
+        paragraph_count = len(duplicates.split_paragraphs(ch.content))
+        st.caption(f"{paragraph_count} paragraphs. Pick a range, or paste a passage to locate it.")
+        r1, r2 = st.columns(2)
+        start = r1.number_input("From paragraph", min_value=1, max_value=max(1, paragraph_count), value=1, key=f"{key}_start")
+        end = r2.number_input("To paragraph", min_value=1, max_value=max(1, paragraph_count), value=1, key=f"{key}_end")
+        marker = st.text_area("...or paste the passage to rewrite (optional)", height=80, key=f"{key}_marker")
+        section_notes = st.text_input("What should change?", key=f"{key}_notes")
+        if st.button("🔄 Rewrite Section", key=f"{key}_go"):
+            if not section_notes:
+                st.warning("Enter notes.")
+                return
+            try:
+                with st.spinner("Rewriting section..."):
+                    result = chapter.regenerate_section(session, ch.id, section_notes, int(start), int(end), marker or None)
+                if result is None:
+                    st.error("The section could not be rewritten (see logs); the chapter was left unchanged.")
+                else:
+                    notifications.send_notification(f"Rewrote a section of Chapter {ch.chapter_number}.")
+                    st.rerun()
+            except ValueError as e:
+                st.error(str(e))
+
+def stuck_generation_notice(session, obj, label: str):
+    """Generating elsewhere; once the claim is stale (e.g. the process was killed) offer a reset."""
+    if not state_machine.is_stale_claim(obj):
+        st.info(f"{label} is being generated in another session. The page updates when it's ready.")
+        return
+    st.warning(f"{label} has been generating for over {state_machine.CLAIM_TIMEOUT} and looks abandoned.")
+    if st.button("♻️ Reset stuck generation", key=f"reset_{type(obj).__name__}_{obj.id}"):
+        state_machine.release(session, obj)
+        st.rerun()
+
+def candidate_count_input(key: str):
+    """How many candidates to draft per round, and whether to vary the temperature."""
+    c1, c2 = st.columns(2)
+    best_of = c1.number_input("Candidates per round", min_value=1, max_value=candidates.MAX_COUNT,
+                              value=candidates.count(), key=f"{key}_best_of")
+    vary = c2.checkbox("Vary temperature", value=True, key=f"{key}_vary", disabled=best_of < 2)
+    return int(best_of), vary
+
+def candidate_picker(session, rows, key: str):
+    """Alternatives side by side, best-ranked first; the selected one is what gets approved."""
+    if len(rows) < 2:
+        return
+    st.markdown("#### Candidates")
+    st.caption("Pre-ranked by a local scorer. Pick one to make it the version under review.")
+    for column, row in zip(st.columns(len(rows)), rows):
+        with column:
+            label = f"#{row.rank} · T={row.temperature:.2f} · score {row.score:.2f}"
+            st.markdown(f"**{label}** {'✅' if row.selected else ''}")
+            for line in (row.notes or "").split("\n"):
+                if line.startswith(("[Quality gate]", "[Duplicates]")):
+                    st.caption(f"⚠️ {line}")
+            st.text_area(label, row.content, height=400, disabled=True, label_visibility="collapsed", key=f"{key}_text_{row.id}")
+            if not row.selected and st.button("Use this", key=f"{key}_pick_{row.id}"):
+                candidates.select_candidate(session, row.id)
+                st.rerun()
+
+LIVE_POLL_SECONDS = 2
+
+@st.fragment(run_every=LIVE_POLL_SECONDS)
+def live_updates(book_id: int):
+    """
+    Polls the change feed after this tab's cursor. Only this small fragment
+    reruns on the timer; the page reruns only when the selected book changed
+    (e.g. a chapter finished generating in another tab or the CLI).
+    """
+    # Own session: the fragment also runs inside the page's session scope
+    with SessionFactory() as feed_session:
+        events = changes.poll(feed_session, st.session_state.change_cursor, book_id)
+    if events:
+        st.session_state.change_cursor = events[-1].seq
+        st.rerun(scope="app")
+
+@st.fragment(run_every=LIVE_POLL_SECONDS)
+def notification_log():
+    """
+    This tab's notifications. They reach the log from the dispatcher thread
+    after the action's rerun, so the panel refreshes itself.
+    """
+    with st.expander("🔔 Notification Log"):
+        recent = notifications.recent_notifications(5) # Show last 5
+        if recent:
+            for msg in recent:
+                st.text(msg)
+            if st.button("Clear Log"):
+                notifications.clear_log()
+                st.rerun(scope="fragment")
+        else:
+            st.caption("No recent notifications.")
+
 # Sidebar: Book Selection
 st.sidebar.title("📚 Book Manager")
 
@@ -33,9 +130,11 @@ with st.sidebar.expander("Start New Book", expanded=False):
             with get_db() as session:
                 book = Book(title=new_title, status="PLANNING")
                 session.add(book)
+                changes.record(session, book, "created")
                 session.commit()
                 st.success(f"Created '{new_title}'!")
                 # Attempt to generate outline immediately
+                notifications.send_notification(f"Starting outline generation for: {new_title}")
                 outline.create_initial_outline(session, book.id, new_notes)
                 st.rerun()
 
@@ -43,26 +142,49 @@ with st.sidebar.expander("Start New Book", expanded=False):
 st.sidebar.markdown("---")
 st.sidebar.subheader("Your Library")
 
+LIBRARY_PAGE_SIZE = 20
+READER_PAGE_BYTES = 20000
+
 with get_db() as session:
-    books = session.execute(select(Book).order_by(Book.id.desc())).scalars().all()
+    # Only one page of (id, title, status) rows is loaded per rerun
+    search = st.sidebar.text_input("🔍 Search titles", key="library_search")
+    if st.session_state.get("library_last_search") != search:
+        st.session_state.library_page = 0
+        st.session_state.library_last_search = search
+    page = st.session_state.get("library_page", 0)
     
-    if not books:
-        st.sidebar.info("No books yet.")
+    book_rows, total_books = library.list_books(session, search, page, LIBRARY_PAGE_SIZE)
+    page_count = max(1, -(-total_books // LIBRARY_PAGE_SIZE))
+    
+    if not book_rows:
+        st.sidebar.info("No books yet." if not search else "No matching books.")
         selected_book_id = None
     else:
-        book_options = {b.id: f"{b.title} ({b.status})" for b in books}
+        titles = {r.id: r.title for r in book_rows}
         selected_book_id = st.sidebar.radio(
             "Select a Book:",
-            options=books,
-            format_func=lambda x: f"{x.title}",
-            key="selected_book_obj"
-        ).id
+            options=list(titles),
+            format_func=lambda x: titles[x],
+            key=f"selected_book_{page}"
+        )
+        
+        p1, p2, p3 = st.sidebar.columns([1, 2, 1])
+        if p1.button("◀", disabled=page == 0):
+            st.session_state.library_page = page - 1
+            st.rerun()
+        p2.caption(f"Page {page + 1}/{page_count} · {total_books} books")
+        if p3.button("▶", disabled=page + 1 >= page_count):
+            st.session_state.library_page = page + 1
+            st.rerun()
         
         st.sidebar.markdown("---")
         if st.sidebar.button("❌ Delete Selected Book", type="primary"):
             with get_db() as session:
                 b_to_del = session.get(Book, selected_book_id)
+                changes.record(session, b_to_del, "deleted") # Lets other tabs drop it
                 session.delete(b_to_del)
+                duplicates.remove_book(session, selected_book_id)
+                candidates.remove_book(session, selected_book_id)
                 session.commit()
                 st.sidebar.success(f"Deleted '{b_to_del.title}'")
                 time.sleep(1)
@@ -70,35 +192,82 @@ with get_db() as session:
         
     with st.sidebar.expander("🛠️ Database Inspector"):
         if st.checkbox("Show Raw Tables"):
-            st.subheader("Books Table")
-            st.dataframe([{"ID": b.id, "Title": b.title, "Status": b.status} for b in books])
+            st.subheader("Books Table (current page)")
+            st.dataframe([{"ID": r.id, "Title": r.title, "Status": r.status} for r in book_rows])
             
             if selected_book_id:
                 st.subheader("Chapters Table")
-                with get_db() as session:
-                   chaps = session.get(Book, selected_book_id).chapters
-                   st.dataframe([{"#": c.chapter_number, "Title": c.title, "Status": c.status} for c in chaps])
+                chaps = library.chapter_index(session, selected_book_id)
+                st.dataframe([{"#": c.chapter_number, "Title": c.title, "Status": c.status} for c in chaps])
 
     # Persistent Notification Log
     st.sidebar.markdown("---")
-    with st.sidebar.expander("🔔 Notification Log"):
-        if 'notification_log' in st.session_state and st.session_state['notification_log']:
-            for msg in reversed(st.session_state['notification_log'][-5:]): # Show last 5
-                st.text(msg)
-            if st.sidebar.button("Clear Log"):
-                st.session_state['notification_log'] = []
-                st.rerun()
-        else:
-            st.caption("No recent notifications.")
+    with st.sidebar:
+        notification_log()
 
 # Main Content Area
 if selected_book_id:
     with get_db() as session:
+        # Cursor first: anything committed after it triggers a rerun via live_updates
+        st.session_state.change_cursor = changes.latest(session)
+        live_updates(selected_book_id)
+        
         # Refresh book object attached to this session
         book = session.get(Book, selected_book_id)
         
         st.title(f"📖 {book.title}")
         st.markdown(f"**Status:** `{book.status}`")
+        
+        budget_status = budget.status(session, book)
+        if budget_status["budget"]:
+            used_share = min(1.0, budget_status["used"] / budget_status["budget"])
+            st.progress(used_share, text=f"Token budget: {budget_status['used']:,}/{budget_status['budget']:,} "
+                                         f"({budget_status['mode']}, ${budget_status['cost_usd']:.4f})")
+            if budget_status["exceeded"]:
+                if budget_status["mode"] == "hard":
+                    st.error("Token budget exhausted: generation is stopped for this book. Raise the budget to continue.")
+                else:
+                    st.warning("Token budget exceeded (warn mode).")
+        
+        with st.expander("💰 Budget Settings"):
+            with st.form("budget_form"):
+                new_budget = st.number_input("Token budget (0 = default/unlimited)", min_value=0, step=10000, value=book.token_budget or 0)
+                new_mode = st.selectbox("When exceeded", ["warn", "hard"], index=0 if budget.book_mode(book) == "warn" else 1)
+                new_target = st.number_input("Target book length in words (0 = none)", min_value=0, step=1000, value=book.target_words or 0)
+                if st.form_submit_button("Save"):
+                    book.token_budget = new_budget or None
+                    book.budget_mode = new_mode
+                    book.target_words = new_target or None
+                    session.commit()
+                    st.rerun()
+            next_cap = budget.chapter_max_tokens(session, book)
+            st.caption(f"Next chapter max_tokens: {next_cap if next_cap else 'default'}")
+        
+        with st.expander("🔁 Repeated Passages"):
+            if st.button("Scan approved chapters"):
+                report = duplicates.duplicate_report(session, book_id=book.id)
+                if report:
+                    st.dataframe(report)
+                else:
+                    st.caption("No near-duplicate paragraphs found.")
+        
+        with st.expander("📊 Cost & Latency"):
+            # Expander bodies run on every rerun, so the reports are only built on request
+            if st.toggle("Show report", key=f"metrics_report_{book.id}"):
+                report = metrics.book_report(session, book.id)
+                if report:
+                    st.dataframe(report)
+                    st.caption(f"Total: {sum(r['seconds'] for r in report):.1f}s, "
+                               f"{sum(r['prompt_tokens'] + r['completion_tokens'] for r in report)} tokens, "
+                               f"${sum(r['cost_usd'] for r in report):.4f}")
+                else:
+                    st.caption("No metrics recorded for this book yet.")
+            if st.button("Prepare Prometheus export", key=f"prometheus_{book.id}"):
+                st.session_state.prometheus_text = metrics.prometheus_text(session)
+            if "prometheus_text" in st.session_state:
+                # Popped so a stale snapshot isn't offered again on later reruns
+                st.download_button("Download metrics.prom", st.session_state.pop("prometheus_text"),
+                                   file_name="metrics.prom", mime="text/plain")
         st.divider()
         
         # --- PLANNING PHASE ---
@@ -111,23 +280,32 @@ if selected_book_id:
                     outline.create_initial_outline(session, book.id, "Auto-generated")
                     st.rerun()
             
+            if book.outline.status == "generating":
+                stuck_generation_notice(session, book.outline, "The outline")
+            
             st.text_area("Current Outline", book.outline.content, height=400)
+            candidate_picker(session, candidates.list_candidates(session, book.id), "outline")
+            best_of, vary = candidate_count_input("outline")
             
             col1, col2 = st.columns([1, 2])
             with col1:
                 if st.button("✅ Approve Outline", type="primary"):
-                    outline.approve_outline(session, book.id)
-                    with st.spinner("Parsing chapters..."):
-                        chapter.parse_chapters_from_outline(session, book.id)
-                    st.success("Outline approved! Moving to Writing phase.")
-                    st.rerun()
+                    if outline.approve_outline(session, book.id):
+                        notifications.send_notification("Outline Approved. Parsing chapters...")
+                        with st.spinner("Parsing chapters..."):
+                            chapter.parse_chapters_from_outline(session, book.id)
+                        st.success("Outline approved! Moving to Writing phase.")
+                        st.rerun()
+                    else:
+                        st.error("The outline can't be approved right now (it is being regenerated or changed in another session).")
             
             with col2:
                 notes = st.text_input("Feedback for AI (if requesting changes):", placeholder="E.g. Make it strictly 5 chapters.")
                 if st.button("🔄 Request Changes"):
                     if notes:
+                        notifications.send_notification("Regenerating outline with feedback...")
                         with st.spinner("Refining outline..."):
-                            outline.update_outline_with_feedback(session, book.id, notes)
+                            outline.update_outline_with_feedback(session, book.id, notes, best_of, vary)
                         st.rerun()
                     else:
                         st.error("Please enter feedback notes first.")
@@ -136,8 +314,8 @@ if selected_book_id:
         elif book.status == "WRITING_CHAPTERS":
             st.subheader("✍️ Writing Phase")
             
-            # Show Chapter Progress
-            chapters = book.chapters
+            # Show Chapter Progress (index only; content is loaded per chapter below)
+            chapters = library.chapter_index(session, book.id)
             if not chapters:
                 st.error("No chapters found! Parsing error?")
                 if st.button("Retry Parsing"):
@@ -149,37 +327,73 @@ if selected_book_id:
                 progress = completed / total if total > 0 else 0
                 st.progress(progress, text=f"Progress: {completed}/{total} Chapters")
                 
+                # Chapter navigator: only the picked chapter's content is fetched
+                approved = [c for c in chapters if c.status == "APPROVED"]
+                if approved:
+                    with st.expander("📚 Browse Approved Chapters"):
+                        picked = st.selectbox(
+                            "Chapter",
+                            options=[c.id for c in approved],
+                            format_func=lambda cid: next(f"{c.chapter_number}. {c.title}" for c in approved if c.id == cid),
+                            index=None,
+                            placeholder="Pick a chapter to read...",
+                        )
+                        if picked:
+                            picked_chapter = session.get(Chapter, picked)
+                            st.text_area("Approved Content", picked_chapter.content, height=400, disabled=True)
+                            section_rewrite_form(session, picked_chapter, f"approved_{picked}")
+                
                 # Find active chapter
-                current_chapter = next((c for c in chapters if c.status != "APPROVED"), None)
+                current_row = next((c for c in chapters if c.status != "APPROVED"), None)
+                current_chapter = session.get(Chapter, current_row.id) if current_row else None
                 
                 if not current_chapter:
                     # All done
                     st.success("🎉 All chapters written!")
                     if st.button("Compile Final Book", type="primary"):
-                        book_compiler.compile_book(session, book.id)
-                        st.rerun()
+                        if book_compiler.compile_book(session, book.id):
+                            notifications.send_notification(f"'{book.title}' compiled.")
+                            st.rerun()
+                        st.error("The book could not be compiled right now (see logs).")
                 else:
                     st.markdown(f"### Current: Chapter {current_chapter.chapter_number} - {current_chapter.title}")
                     st.caption(f"Status: {current_chapter.status}")
                     
+                    scene_mode = st.checkbox(
+                        "🎬 Draft scene-by-scene (parallel, for long chapters)",
+                        value=llm_client.SCENE_MODE_DEFAULT,
+                        key="scene_mode"
+                    )
+                    best_of, vary = candidate_count_input("chapter")
+                    
                     if current_chapter.status == "PENDING":
                         notes = st.text_input("Notes for this chapter (optional):")
                         if st.button("✨ Generate Chapter content"):
                             with st.spinner("Writing chapter..."):
-                                chapter.generate_next_chapter(session, book.id, notes)
+                                if chapter.generate_next_chapter(session, book.id, notes, scene_mode=scene_mode, best_of=best_of, vary_temperature=vary):
+                                    notifications.send_notification(f"Generated Chapter {current_chapter.chapter_number}.")
                                 st.toast(f"Generated Chapter {current_chapter.chapter_number}", icon="✅")
                                 time.sleep(1) # Wait for toast
                             st.rerun()
                             
+                    elif current_chapter.status == "GENERATING":
+                        stuck_generation_notice(session, current_chapter, "This chapter")
+                            
                     elif current_chapter.status in ["WAITING_FOR_REVIEW", "DRAFT"]:
                         st.markdown("#### Review Content")
+                        for line in (current_chapter.editor_notes or "").split("\n"):
+                            if line.startswith(("[Quality gate]", "[Duplicates]")):
+                                st.warning(line)
                         st.text_area("Chapter Content", current_chapter.content, height=600)
+                        candidate_picker(session, candidates.list_candidates(session, book.id, current_chapter.id), f"chapter_{current_chapter.id}")
                         
                         c1, c2 = st.columns(2)
                         with c1:
                             if st.button("✅ Approve Chapter", type="primary"):
                                 with st.spinner("Summarizing and saving..."):
                                     chapter.approve_chapter(session, current_chapter.id)
+                                    if current_chapter.status == "APPROVED":
+                                        notifications.send_notification(f"Chapter {current_chapter.chapter_number} Approved.")
                                     st.toast("Chapter Approved!", icon="🎉")
                                     time.sleep(1)
                                 st.rerun()
@@ -187,11 +401,14 @@ if selected_book_id:
                             feedback = st.text_input("Refinement Notes:")
                             if st.button("🔄 Rewrite Chapter"):
                                 if feedback:
+                                    notifications.send_notification(f"Rewriting Chapter {current_chapter.chapter_number} with feedback...")
                                     with st.spinner("Rewriting..."):
-                                        chapter.regenerate_chapter(session, current_chapter.id, feedback)
+                                        chapter.regenerate_chapter(session, current_chapter.id, feedback, scene_mode=scene_mode, best_of=best_of, vary_temperature=vary)
                                     st.rerun()
                                 else:
                                     st.warning("Enter notes.")
+                        
+                        section_rewrite_form(session, current_chapter, f"review_{current_chapter.id}")
 
         # --- COMPLETED PHASE ---
         elif book.status == "COMPLETED":
@@ -202,22 +419,26 @@ if selected_book_id:
             full_path = os.path.abspath(compile_path)
             
             if os.path.exists(full_path):
-                with open(full_path, "r", encoding='utf-8') as f:
-                    data = f.read()
-                
-                st.download_button(
-                    label="📥 Download Book (.txt)",
-                    data=data,
-                    file_name=compile_path,
-                    mime="text/plain"
-                )
+                # The file is only read in full when the user asks to download it
+                if st.button("📦 Prepare Download"):
+                    with open(full_path, "rb") as f:
+                        st.download_button(
+                            label="📥 Download Book (.txt)",
+                            data=f,
+                            file_name=compile_path,
+                            mime="text/plain"
+                        )
                 
-                st.text_area("Preview", data, height=500)
+                # Paged reader: only the visible window is read from disk
+                page_count = library.compiled_page_count(full_path, READER_PAGE_BYTES)
+                reader_page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1)
+                st.text_area("Preview", library.read_compiled_page(full_path, reader_page - 1, READER_PAGE_BYTES), height=500)
             else:
                 st.error("File not found on disk. Re-compile?")
                 if st.button("Re-compile"):
-                    book_compiler.compile_book(session, book.id)
-                    st.rerun()
+                    if book_compiler.compile_book(session, book.id):
+                        st.rerun()
+                    st.error("The book could not be compiled right now (see logs).")
 
 else:
     st.info("👈 Select a book from the sidebar or Create a New One.")
@@ -2,7 +2,7 @@ import os
 from datetime import datetime
 from typing import List, Optional
 
-from sqlalchemy import create_engine, ForeignKey, String, Text, Integer, DateTime
+from sqlalchemy import create_engine, inspect, text, ForeignKey, String, Text, Integer, DateTime, Boolean, Float, LargeBinary, BigInteger, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker, scoped_session
 
 # Use SQLite for now. Can be swapped for Supabase/Postgres connection string.
@@ -23,6 +23,14 @@ class Book(Base):
     # Status: PLANNING, WRITING_OUTLINE, REVIEWING_OUTLINE, WRITING_CHAPTERS, REVIEWING_CHAPTER, COMPLETED
     status: Mapped[str] = mapped_column(String(50), default="PLANNING")
     created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    # Token budget settings, see modules/budget.py (None = env defaults)
+    token_budget: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    budget_mode: Mapped[Optional[str]] = mapped_column(String(10), nullable=True) # warn | hard
+    target_words: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # Bumped on every status/content change (optimistic concurrency, see modules/state_machine.py)
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
+    
+    __mapper_args__ = {"version_id_col": version}
     
     outline: Mapped["Outline"] = relationship(back_populates="book", uselist=False, cascade="all, delete-orphan")
     chapters: Mapped[List["Chapter"]] = relationship(back_populates="book", cascade="all, delete-orphan", order_by="Chapter.chapter_number")
@@ -36,6 +44,11 @@ class Outline(Base):
     # Status: DRAFT, WAITING_FOR_REVIEW, APPROVED
     status: Mapped[str] = mapped_column(String(50), default="DRAFT")
     editor_notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
+    # When the current "generating" claim was taken (claims expire, see state_machine.py)
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    
+    __mapper_args__ = {"version_id_col": version}
     
     book: Mapped["Book"] = relationship(back_populates="outline")
 
@@ -48,15 +61,145 @@ class Chapter(Base):
     title: Mapped[str] = mapped_column(String(200))
     content: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
     summary: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
-    # Status: PENDING, DRAFT, WAITING_FOR_REVIEW, APPROVED
+    # Status: PENDING, DRAFT, GENERATING, WAITING_FOR_REVIEW, APPROVED
     status: Mapped[str] = mapped_column(String(50), default="PENDING")
     editor_notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    version: Mapped[int] = mapped_column(Integer, default=1, server_default="1")
+    # When the current GENERATING claim was taken (claims expire, see state_machine.py)
+    claimed_at: Mapped[Optional[datetime]] = mapped_column(DateTime, nullable=True)
+    
+    __mapper_args__ = {"version_id_col": version}
     
     book: Mapped["Book"] = relationship(back_populates="chapters")
 
+class ImportJob(Base):
+    """Checkpoint for a (possibly interrupted) library import, see modules/archive.py."""
+    __tablename__ = "import_jobs"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    export_id: Mapped[str] = mapped_column(String(64), unique=True)
+    source: Mapped[str] = mapped_column(String(500))
+    # Number of archive lines already committed
+    lines_done: Mapped[int] = mapped_column(Integer, default=0)
+    # Book that chapters after `lines_done` belong to
+    current_book_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    finished: Mapped[bool] = mapped_column(Boolean, default=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class MetricEvent(Base):
+    """One timed stage (LLM call, commit, compile step), see metrics.py."""
+    __tablename__ = "metric_events"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    # e.g. llm.chapter, llm.summary, db.commit, compile.write
+    name: Mapped[str] = mapped_column(String(100), index=True)
+    book_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
+    chapter_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    started_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+    duration_ms: Mapped[float] = mapped_column(Float)
+    prompt_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    completion_tokens: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # ok / error
+    status: Mapped[str] = mapped_column(String(20), default="ok")
+    # Template and version of a prompts.py prompt (llm.* spans only), e.g. chapter/v1
+    prompt_version: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
+
+class NotificationOutbox(Base):
+    """Failed notification deliveries awaiting retry, see modules/notifications.py."""
+    __tablename__ = "notification_outbox"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    sink: Mapped[str] = mapped_column(String(50))
+    subject: Mapped[str] = mapped_column(String(300))
+    message: Mapped[str] = mapped_column(Text)
+    attempts: Mapped[int] = mapped_column(Integer, default=0)
+    last_error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    next_attempt_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow, index=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class ParagraphSignature(Base):
+    """MinHash signature of one paragraph of an approved chapter, see modules/duplicates.py."""
+    __tablename__ = "paragraph_signatures"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    book_id: Mapped[int] = mapped_column(Integer, index=True)
+    chapter_id: Mapped[int] = mapped_column(Integer, index=True)
+    paragraph_index: Mapped[int] = mapped_column(Integer)
+    signature: Mapped[bytes] = mapped_column(LargeBinary)
+    preview: Mapped[str] = mapped_column(String(200))
+
+class LshBucket(Base):
+    """LSH band bucket membership of a paragraph signature."""
+    __tablename__ = "lsh_buckets"
+    __table_args__ = (Index("ix_lsh_buckets_band_bucket", "bucket", "band"),)
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    band: Mapped[int] = mapped_column(Integer)
+    bucket: Mapped[int] = mapped_column(BigInteger)
+    signature_id: Mapped[int] = mapped_column(ForeignKey("paragraph_signatures.id"), index=True)
+
+class Candidate(Base):
+    """One of N alternative drafts for an outline or chapter, see modules/candidates.py."""
+    __tablename__ = "candidates"
+    
+    id: Mapped[int] = mapped_column(primary_key=True)
+    book_id: Mapped[int] = mapped_column(Integer, index=True)
+    # None for outline candidates
+    chapter_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True, index=True)
+    # outline / chapter
+    kind: Mapped[str] = mapped_column(String(20))
+    content: Mapped[str] = mapped_column(Text)
+    temperature: Mapped[float] = mapped_column(Float)
+    # Local pre-ranking score (higher is better); rank 1 is the best
+    score: Mapped[Optional[float]] = mapped_column(Float, nullable=True)
+    rank: Mapped[int] = mapped_column(Integer, default=1)
+    # Editor notes to apply if this candidate is picked (quality gate, duplicates)
+    notes: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+    selected: Mapped[bool] = mapped_column(Boolean, default=False)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
+class ChangeEvent(Base):
+    """Append-only change feed for status/content changes, see modules/changes.py."""
+    __tablename__ = "change_events"
+    # AUTOINCREMENT: sequence numbers are never reused, so a client cursor stays valid
+    __table_args__ = (Index("ix_change_events_book_seq", "book_id", "seq"), {"sqlite_autoincrement": True})
+    
+    seq: Mapped[int] = mapped_column(Integer, primary_key=True, autoincrement=True)
+    book_id: Mapped[int] = mapped_column(Integer)
+    # Set for chapter events
+    chapter_id: Mapped[Optional[int]] = mapped_column(Integer, nullable=True)
+    # book / outline / chapter
+    entity: Mapped[str] = mapped_column(String(20))
+    entity_id: Mapped[int] = mapped_column(Integer)
+    # created / status / content / deleted
+    kind: Mapped[str] = mapped_column(String(20))
+    # Status after the change
+    status: Mapped[Optional[str]] = mapped_column(String(50), nullable=True)
+    created_at: Mapped[datetime] = mapped_column(DateTime, default=datetime.utcnow)
+
 def init_db():
     """Initialize the database tables."""
     Base.metadata.create_all(engine)
+    _add_missing_columns()
+
+def _add_missing_columns():
+    """
+    create_all() only creates missing tables, so databases created by an older
+    version of the app are patched here with any columns added since.
+    """
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {c["name"] for c in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column.type.compile(engine.dialect)}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT {column.server_default.arg}"
+                conn.execute(text(ddl))
 
 def get_session():
     """Get a new database session."""
@@ -1,8 +1,12 @@
 import os
+import re
 import logging
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
 from dotenv import load_dotenv
 from groq import Groq
+import metrics
+import prompts
 
 # Load environment variables
 load_dotenv()
@@ -22,7 +26,33 @@ else:
 
 MODEL_NAME = "openai/gpt-oss-20b" # Updated to supported model
 
-def generate_outline_from_llm(title: str, notes: str) -> str:
+# Scene mode: plan a chapter into scenes, draft them in parallel, then smooth the seams.
+# Off by default; SCENE_DRAFTING=1 turns it on for every chapter.
+SCENE_MODE_DEFAULT = os.getenv("SCENE_DRAFTING", "").lower() in ("1", "true", "yes")
+MAX_SCENES = int(os.getenv("MAX_SCENES", "6"))
+SCENE_MAX_TOKENS = 3000
+
+# Default sampling temperatures (best-of-N candidates spread around these, see modules/candidates.py)
+OUTLINE_TEMPERATURE = 0.7
+CHAPTER_TEMPERATURE = 0.8 # Slightly higher for creativity
+
+def _chat(stage: str, messages: list, temperature: float, max_tokens: Optional[int] = None, prompt_version: Optional[str] = None):
+    """
+    Single entry point for completions: traced as `llm.<stage>` with token usage
+    (and prompt_version, e.g. prompts.Prompt.label, for versioned templates).
+    """
+    kwargs = {"max_tokens": max_tokens} if max_tokens else {}
+    with metrics.span(f"llm.{stage}", prompt_version=prompt_version) as span:
+        completion = client.chat.completions.create(
+            model=MODEL_NAME,
+            messages=messages,
+            temperature=temperature,
+            **kwargs
+        )
+        span.record_usage(getattr(completion, "usage", None))
+    return completion
+
+def generate_outline_from_llm(title: str, notes: str, temperature: float = OUTLINE_TEMPERATURE) -> str:
     """Generate a book outline based on title and notes."""
     if not client:
         return "Error: GROQ_API_KEY not set."
@@ -42,20 +72,20 @@ def generate_outline_from_llm(title: str, notes: str) -> str:
     """
     
     try:
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
+        completion = _chat(
+            "outline",
+            [
                 {"role": "system", "content": "You are a professional book outliner."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7,
+            temperature=temperature,
         )
         return completion.choices[0].message.content
     except Exception as e:
         logger.error(f"Error generating outline: {e}")
         return f"Error creating outline: {str(e)}"
 
-def regenerate_outline_from_llm(current_outline: str, feedback: str) -> str:
+def regenerate_outline_from_llm(current_outline: str, feedback: str, temperature: float = OUTLINE_TEMPERATURE) -> str:
     """Refine existing outline based on feedback."""
     if not client:
         return "Error: GROQ_API_KEY not set."
@@ -71,63 +101,93 @@ def regenerate_outline_from_llm(current_outline: str, feedback: str) -> str:
     """
     
     try:
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
+        completion = _chat(
+            "outline_revision",
+            [
                 {"role": "system", "content": "You are a professional book editor."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.7,
+            temperature=temperature,
         )
         return completion.choices[0].message.content
     except Exception as e:
         logger.error(f"Error updating outline: {e}")
         return f"Error updating outline: {str(e)}"
 
-def generate_chapter_content(book_title: str, chapter_title: str, outline_context: str, previous_summaries: str, notes: Optional[str] = "") -> str:
-    """Generate full text for a chapter."""
+def generate_chapter_content(book_title: str, chapter_title: str, outline_context: str, previous_summaries: str, notes: Optional[str] = "", scene_mode: Optional[bool] = None, max_tokens: Optional[int] = None, chapter_number: Optional[int] = None, temperature: float = CHAPTER_TEMPERATURE) -> str:
+    """
+    Generate full text for a chapter.
+    max_tokens caps the completion (None = 6000, or per-scene defaults in scene mode).
+    chapter_number selects the outline window (see prompts.py); without it the chapter is found by title.
+    """
     if not client:
         return "Error: GROQ_API_KEY not set."
 
-    context_str = ""
-    if previous_summaries:
-        context_str = f"STORY SO FAR (Summaries of previous chapters):\n{previous_summaries}\n"
-    else:
-        context_str = "This is the first chapter.\n"
+    if scene_mode if scene_mode is not None else SCENE_MODE_DEFAULT:
+        return generate_chapter_by_scenes(book_title, chapter_title, outline_context, previous_summaries, notes, max_tokens, chapter_number, temperature)
 
+    prompt = prompts.build_chapter_prompt("chapter", book_title, chapter_title, outline_context, previous_summaries, notes, chapter_number)
+    logger.debug(prompt.describe())
+
+    try:
+        completion = _chat(
+            "chapter",
+            prompt.messages,
+            temperature=temperature,
+            max_tokens=max_tokens or 6000, # Allow for long chapters
+            prompt_version=prompt.label,
+        )
+        return completion.choices[0].message.content
+    except Exception as e:
+        logger.error(f"Error generating chapter: {e}")
+        return f"Error generating chapter: {str(e)}"
+
+def regenerate_passage(book_title: str, chapter_title: str, before: str, passage: str, after: str, notes: str, max_tokens: Optional[int] = None) -> Optional[str]:
+    """
+    Rewrite one span of a chapter so it splices back between `before` and `after`.
+    Returns None if the call fails, so no error text can end up in the chapter.
+    """
+    if not client:
+        logger.error("Error regenerating passage: GROQ_API_KEY not set.")
+        return None
+    
     prompt = f"""
     Book Title: {book_title}
-    Current Chapter: {chapter_title}
+    Chapter: {chapter_title}
     
-    Full Book Outline Reference:
-    {outline_context}
+    Text BEFORE the passage (do not repeat or change it):
+    {before if before else "(start of chapter)"}
     
-    Context:
-    {context_str}
+    PASSAGE TO REWRITE:
+    {passage}
     
-    Specific Author Notes for this Chapter:
-    {notes if notes else "None"}
+    Text AFTER the passage (do not repeat or change it):
+    {after if after else "(end of chapter)"}
+    
+    Editor Notes for the rewrite:
+    {notes}
     
     Task:
-    Write the complete content for '{chapter_title}'. 
-    Write in an engaging style suitable for the topic.
-    Ensure continuity with previous chapters.
+    Rewrite ONLY the passage, applying the editor notes. It must flow seamlessly from the text before
+    into the text after, in the same voice and tense. Keep roughly the same length unless the notes say otherwise.
+    Output only the rewritten passage, with paragraphs separated by blank lines.
     """
-
+    
     try:
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
-                {"role": "system", "content": "You are a best-selling author."},
+        completion = _chat(
+            "passage",
+            [
+                {"role": "system", "content": "You are a best-selling author revising your own draft."},
                 {"role": "user", "content": prompt}
             ],
-            temperature=0.8, # Slightly higher for creativity
-            max_tokens=6000 # Allow for long chapters
+            temperature=0.7,
+            # Bounded by the passage, not the chapter
+            max_tokens=max_tokens or max(600, int(len(passage.split()) * 2.5)),
         )
         return completion.choices[0].message.content
     except Exception as e:
-        logger.error(f"Error generating chapter: {e}")
-        return f"Error generating chapter: {str(e)}"
+        logger.error(f"Error regenerating passage: {e}")
+        return None
 
 def summarize_text(text: str) -> str:
     """Create a concise summary of the chapter for context window."""
@@ -143,9 +203,9 @@ def summarize_text(text: str) -> str:
     """ # Note: Llama 3 has a large context, but good to be safe.
     
     try:
-        completion = client.chat.completions.create(
-            model=MODEL_NAME,
-            messages=[
+        completion = _chat(
+            "summary",
+            [
                 {"role": "system", "content": "You are a summarizer bot."},
                 {"role": "user", "content": prompt}
             ],
@@ -155,3 +215,113 @@ def summarize_text(text: str) -> str:
     except Exception as e:
         logger.error(f"Error summarizing: {e}")
         return f"Error summarizing: {str(e)}"
+
+def plan_chapter_scenes(book_title: str, chapter_title: str, outline_context: str, previous_summaries: str, notes: Optional[str] = "", chapter_number: Optional[int] = None) -> List[str]:
+    """Cheap planning call: break a chapter into a short list of scene descriptions."""
+    prompt = prompts.build_chapter_prompt(
+        "scene_plan", book_title, chapter_title, outline_context, previous_summaries, notes, chapter_number,
+        max_scenes=MAX_SCENES,
+    )
+    logger.debug(prompt.describe())
+    
+    completion = _chat(
+        "scene_plan",
+        prompt.messages,
+        temperature=0.4,
+        max_tokens=800,
+        prompt_version=prompt.label,
+    )
+    text = completion.choices[0].message.content or ""
+    scenes = re.findall(r'^\W*scene\s+\d+\W*[:.-]\s*(.+)$', text, re.IGNORECASE | re.MULTILINE)
+    return [s.strip() for s in scenes][:MAX_SCENES]
+
+def draft_scene(book_title: str, chapter_title: str, outline_context: str, previous_summaries: str, notes: Optional[str], scenes: List[str], index: int, max_tokens: int = SCENE_MAX_TOKENS, chapter_number: Optional[int] = None, temperature: float = CHAPTER_TEMPERATURE) -> str:
+    """Drafts one scene; neighbouring scene plans are included so the pieces line up."""
+    prompt = prompts.build_chapter_prompt(
+        "scene", book_title, chapter_title, outline_context, previous_summaries, notes, chapter_number,
+        scene_plan="\n".join(f"{i + 1}. {s}" for i, s in enumerate(scenes)),
+        previous_scene=scenes[index - 1] if index > 0 else "None (this scene opens the chapter).",
+        next_scene=scenes[index + 1] if index + 1 < len(scenes) else "None (this scene closes the chapter).",
+        scene_number=index + 1,
+        scene=scenes[index],
+    )
+    logger.debug(prompt.describe())
+    
+    completion = _chat(
+        "scene",
+        prompt.messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        prompt_version=prompt.label,
+    )
+    return (completion.choices[0].message.content or "").strip()
+
+def smooth_transition(previous_ending: str, next_opening: str) -> str:
+    """Rewrites the opening paragraph of a scene so it follows on from the previous scene's ending."""
+    prompt = f"""
+    End of the previous scene:
+    {previous_ending}
+    
+    Opening paragraph of the next scene:
+    {next_opening}
+    
+    Task:
+    Rewrite ONLY the opening paragraph so it flows naturally from the previous scene's ending
+    (no repeated information, consistent tense and point of view). Keep its content and length.
+    Output only the rewritten paragraph.
+    """
+    
+    completion = _chat(
+        "scene_transition",
+        [
+            {"role": "system", "content": "You are a meticulous line editor."},
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.3,
+        max_tokens=600,
+    )
+    return (completion.choices[0].message.content or "").strip()
+
+def generate_chapter_by_scenes(book_title: str, chapter_title: str, outline_context: str, previous_summaries: str, notes: Optional[str] = "", max_tokens: Optional[int] = None, chapter_number: Optional[int] = None, temperature: float = CHAPTER_TEMPERATURE) -> str:
+    """
+    Plans the chapter into scenes, drafts all scenes concurrently, then smooths
+    each seam (also concurrently). Wall-clock time is roughly plan + one scene +
+    one seam, and chapter length isn't capped by a single response.
+    Falls back to a single-call chapter if planning yields fewer than 2 scenes.
+    """
+    try:
+        scenes = plan_chapter_scenes(book_title, chapter_title, outline_context, previous_summaries, notes, chapter_number)
+    except Exception as e:
+        logger.error(f"Error planning scenes: {e}")
+        scenes = []
+    
+    if len(scenes) < 2:
+        return generate_chapter_content(book_title, chapter_title, outline_context, previous_summaries, notes, scene_mode=False, max_tokens=max_tokens, chapter_number=chapter_number, temperature=temperature)
+    
+    # A chapter-level cap (e.g. from the book's budget) is shared between the scenes
+    scene_tokens = min(SCENE_MAX_TOKENS, max(300, max_tokens // len(scenes))) if max_tokens else SCENE_MAX_TOKENS
+    
+    try:
+        with ThreadPoolExecutor(max_workers=len(scenes)) as pool:
+            drafts = list(pool.map(
+                metrics.propagate(lambda i: draft_scene(
+                    book_title, chapter_title, outline_context, previous_summaries, notes, scenes, i, scene_tokens, chapter_number, temperature
+                )),
+                range(len(scenes))
+            ))
+        
+        # Each seam only needs the tail of one scene and the first paragraph of the next
+        parts = [d.split("\n\n") for d in drafts]
+        with ThreadPoolExecutor(max_workers=len(scenes) - 1) as pool:
+            openings = list(pool.map(
+                metrics.propagate(lambda i: smooth_transition(parts[i - 1][-1], parts[i][0])),
+                range(1, len(parts))
+            ))
+        for i, opening in enumerate(openings, start=1):
+            if opening:
+                parts[i][0] = opening
+    except Exception as e:
+        logger.error(f"Error generating chapter scenes: {e}")
+        return f"Error generating chapter: {str(e)}"
+    
+    return "\n\n".join("\n\n".join(p) for p in parts)
@@ -0,0 +1,243 @@
+"""
+Concurrent-editor load test for the data/workflow layer.
+
+Simulates N editors, each with its own DB session, driving the same module
+functions app.py uses (outline -> chapters -> approve -> compile) against a
+latency-injected stand-in for the Groq client. Concurrency is ramped through
+the given levels and, for each level, throughput, per-operation p50/p99,
+time spent in the DB (which includes SQLite lock waits) and error rates are
+reported.
+
+Usage:
+    python loadtest.py --levels 1,2,4,8 --chapters 3 --latency 0.2
+    python loadtest.py --levels 4,16 --shared-book   # all editors race on one book
+"""
+import argparse
+import contextlib
+import io
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+sys.path.append(os.getcwd())
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+from db import Base, Book
+import llm_client
+import metrics
+from modules import outline, chapter, book_compiler
+
+WORDS = ["river", "lantern", "quiet", "engine", "harbor", "signal", "winter", "copper", "garden", "letter",
+         "mountain", "shadow", "station", "promise", "orchard", "window", "compass", "thunder", "meadow", "archive"]
+
+class FakeLLMClient:
+    """Drop-in for `groq.Groq` that sleeps instead of calling the API."""
+
+    def __init__(self, latency: float, jitter: float, chapters: int):
+        self.latency = latency
+        self.jitter = jitter
+        self.chapters = chapters
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, model, messages, temperature=0.7, max_tokens=None, **kwargs):
+        time.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+        system = messages[0]["content"]
+        if "outliner" in system:
+            text = "\n".join(f"Chapter {i}: Load Test Chapter {i}" for i in range(1, self.chapters + 1))
+        elif "summarizer" in system:
+            text = "A short summary of the chapter."
+        else:
+            # Varied prose that passes the quality gate (length, no repetition, on topic)
+            text = "\n\n".join(
+                "The load test chapter " + " ".join(random.choice(WORDS) for _ in range(60)) + "."
+                for _ in range(8)
+            )
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+        return SimpleNamespace(
+            choices=[SimpleNamespace(message=SimpleNamespace(content=text), finish_reason="stop")],
+            usage=SimpleNamespace(prompt_tokens=prompt_tokens, completion_tokens=len(text) // 4,
+                                  total_tokens=prompt_tokens + len(text) // 4),
+        )
+
+class Recorder:
+    """Thread-safe collector of per-operation latencies, DB time and errors."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.db_time = defaultdict(float)
+        self.errors = defaultdict(int)
+        self.lock_errors = 0
+        self.conflicts = 0
+        self.local = threading.local()
+
+    def add_db_time(self, seconds: float):
+        op = getattr(self.local, "op", None)
+        if op:
+            with self.lock:
+                self.db_time[op] += seconds
+
+    def run(self, op: str, fn, *args):
+        self.local.op = op
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except OperationalError as e:
+            with self.lock:
+                self.errors[op] += 1
+                if "locked" in str(e):
+                    self.lock_errors += 1
+            raise
+        except Exception:
+            with self.lock:
+                self.errors[op] += 1
+            raise
+        finally:
+            with self.lock:
+                self.latencies[op].append(time.perf_counter() - start)
+            self.local.op = None
+
+# Recorder of the level currently running; DB hooks report into it
+_active = SimpleNamespace(recorder=None)
+
+def _add_db_time(seconds: float):
+    if _active.recorder:
+        _active.recorder.add_db_time(seconds)
+
+class TimedConnection(sqlite3.Connection):
+    """sqlite3 connection that reports how long COMMIT takes (lock waits included)."""
+
+    def commit(self):
+        start = time.perf_counter()
+        try:
+            super().commit()
+        finally:
+            _add_db_time(time.perf_counter() - start)
+
+def instrument_engine(engine):
+    """Accumulates time spent inside cursor executes (where SQLite waits for locks) per operation."""
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after(conn, cursor, statement, parameters, context, executemany):
+        _add_db_time(time.perf_counter() - conn.info["query_start"].pop())
+
+def percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def editor_session(Session, recorder: Recorder, chapters: int, shared_book_id=None):
+    """One editor: create a book, approve the outline, write and approve every chapter, compile."""
+    with Session() as session:
+        try:
+            if shared_book_id is None:
+                book = Book(title=f"Load Test {threading.get_ident()}-{random.randint(0, 10**6)}", status="PLANNING")
+                recorder.run("create_book", lambda: (session.add(book), session.commit()))
+                book_id = book.id
+                recorder.run("create_initial_outline", outline.create_initial_outline, session, book_id, "load test")
+                recorder.run("approve_outline", outline.approve_outline, session, book_id)
+                recorder.run("parse_chapters", chapter.parse_chapters_from_outline, session, book_id)
+            else:
+                book_id = shared_book_id
+
+            for _ in range(chapters):
+                session.expire_all()
+                generated = recorder.run("generate_next_chapter", chapter.generate_next_chapter, session, book_id, "")
+                if generated is None:
+                    # Lost the claim to another editor (shared-book mode) or book finished
+                    with recorder.lock:
+                        recorder.conflicts += 1
+                    continue
+                recorder.run("approve_chapter", chapter.approve_chapter, session, generated.id)
+
+            if shared_book_id is None:
+                recorder.run("compile_book", book_compiler.compile_book, session, book_id)
+        except Exception:
+            session.rollback()
+
+def run_level(Session, concurrency: int, chapters: int, shared: bool) -> tuple:
+    recorder = Recorder()
+    _active.recorder = recorder
+    shared_book_id = None
+    if shared:
+        with Session() as session:
+            book = Book(title=f"Shared Load Test x{concurrency}", status="PLANNING")
+            session.add(book)
+            session.commit()
+            outline.create_initial_outline(session, book.id, "load test")
+            outline.approve_outline(session, book.id)
+            chapter.parse_chapters_from_outline(session, book.id)
+            shared_book_id = book.id
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(concurrency):
+            pool.submit(editor_session, Session, recorder, chapters, shared_book_id)
+    return recorder, time.perf_counter() - start
+
+def report(concurrency: int, recorder: Recorder, elapsed: float):
+    total_ops = sum(len(v) for v in recorder.latencies.values())
+    total_errors = sum(recorder.errors.values())
+    print(f"\n=== {concurrency} concurrent editors: {total_ops} ops in {elapsed:.2f}s "
+          f"({total_ops / elapsed:.1f} ops/s), errors {total_errors} "
+          f"({(total_errors / total_ops * 100) if total_ops else 0:.1f}%), "
+          f"lock errors {recorder.lock_errors}, lost claims {recorder.conflicts} ===")
+    print(f"{'operation':<24}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}{'db ms/op':>10}{'err %':>8}")
+    for op, values in sorted(recorder.latencies.items()):
+        count = len(values)
+        print(f"{op:<24}{count:>7}"
+              f"{percentile(values, 50) * 1000:>10.1f}{percentile(values, 99) * 1000:>10.1f}"
+              f"{recorder.db_time[op] / count * 1000:>10.1f}"
+              f"{recorder.errors[op] / count * 100:>8.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--levels", default="1,2,4,8", help="Comma separated editor counts to ramp through")
+    parser.add_argument("--chapters", type=int, default=3, help="Chapters per book")
+    parser.add_argument("--latency", type=float, default=0.2, help="Mean fake LLM latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.05, help="Std deviation of fake LLM latency")
+    parser.add_argument("--db", default=None, help="SQLite file to use (default: temporary file)")
+    parser.add_argument("--busy-timeout", type=float, default=5.0, help="SQLite busy timeout in seconds")
+    parser.add_argument("--shared-book", action="store_true", help="All editors work on the same book")
+    parser.add_argument("--verbose", action="store_true", help="Show the modules' progress prints")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bookgen-load-")
+    db_path = os.path.abspath(args.db) if args.db else os.path.join(workdir, "load.db")
+    # compile_book writes into the CWD; keep the output out of the repo
+    os.chdir(workdir)
+
+    engine = create_engine(
+        f"sqlite:///{db_path}",
+        connect_args={"timeout": args.busy_timeout, "factory": TimedConnection},
+    )
+    Base.metadata.create_all(engine)
+    instrument_engine(engine)
+    metrics.configure(engine)
+    Session = sessionmaker(bind=engine)
+
+    llm_client.client = FakeLLMClient(args.latency, args.jitter, args.chapters)
+
+    print(f"DB: {db_path}  |  fake LLM latency {args.latency}s ± {args.jitter}s")
+    for level in [int(x) for x in args.levels.split(",") if x.strip()]:
+        # The workflow modules print progress for every call; hide it unless asked
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+            recorder, elapsed = run_level(Session, level, args.chapters, args.shared_book)
+        report(level, recorder, elapsed)
+
+if __name__ == "__main__":
+    main()
@@ -7,7 +7,8 @@ sys.path.append(os.getcwd())
 
 from db import init_db, get_session, Book, Outline, Chapter
 from sqlalchemy import select
-from modules import outline, chapter, book_compiler, notifications
+import metrics
+from modules import outline, chapter, book_compiler, notifications, state_machine, archive, budget, candidates, changes, duplicates
 
 def clear_screen():
     # Simple clear (optional, maybe just print lines to keep history visible for debugging)
@@ -22,7 +23,10 @@ def main_menu(session):
     print_header()
     print("1. Start a New Book")
     print("2. Continue Existing Book")
-    print("3. Exit")
+    print("3. Export Library")
+    print("4. Import Library")
+    print("5. Export Prometheus Metrics")
+    print("6. Exit")
     
     choice = input("\nSelect an option: ")
     
@@ -31,6 +35,12 @@ def main_menu(session):
     elif choice == "2":
         list_and_select_book(session)
     elif choice == "3":
+        export_books(session)
+    elif choice == "4":
+        import_books(session)
+    elif choice == "5":
+        export_metrics(session)
+    elif choice == "6":
         print("Goodbye!")
         sys.exit(0)
     else:
@@ -45,6 +55,7 @@ def create_new_book(session):
     
     new_book = Book(title=title, status="PLANNING")
     session.add(new_book)
+    changes.record(session, new_book, "created")
     session.commit()
     
     print(f"Book '{title}' created!")
@@ -55,6 +66,30 @@ def create_new_book(session):
     
     manage_book(session, new_book.id)
 
+def export_books(session):
+    print("\n--- EXPORT LIBRARY ---")
+    path = input("Archive file [library.jsonl.gz]: ") or "library.jsonl.gz"
+    ids = input("Book IDs to export (comma separated, blank for all): ")
+    book_ids = [int(x) for x in ids.split(",") if x.strip()] or None
+    archive.export_library(session, path, book_ids)
+    main_menu(session)
+
+def import_books(session):
+    print("\n--- IMPORT LIBRARY ---")
+    path = input("Archive file: ")
+    if not os.path.exists(path):
+        print("File not found.")
+    else:
+        # Safe to re-run after an interruption: it resumes from the last checkpoint
+        archive.import_library(session, path)
+    main_menu(session)
+
+def export_metrics(session):
+    print("\n--- EXPORT METRICS ---")
+    path = input("Output file [metrics.prom]: ") or "metrics.prom"
+    print(f"Wrote Prometheus metrics to: {metrics.export_prometheus(session, path)}")
+    main_menu(session)
+
 def list_and_select_book(session):
     print("\n--- EXISTING BOOKS ---")
     books = session.execute(select(Book)).scalars().all()
@@ -82,14 +117,17 @@ def list_and_select_book(session):
 
 def manage_book(session, book_id):
     while True:
-        # Refresh book state
-        # using expire_all to ensure fresh data from DB
-        session.expire_all() 
+        # Refresh book state: only rows that changed since the last pass
+        # (here or in another session, e.g. the web app) are reloaded
+        changes.sync(session)
         book = session.get(Book, book_id)
         
         clear_screen()
         print(f"MANAGING: {book.title}")
         print(f"STATUS: {book.status}")
+        budget_status = budget.status(session, book)
+        if budget_status["budget"]:
+            print(f"BUDGET: {budget_status['used']}/{budget_status['budget']} tokens ({budget_status['mode']})")
         
         if book.status == "PLANNING":
             handle_planning_phase(session, book)
@@ -101,6 +139,8 @@ def manage_book(session, book_id):
             print("This book is completed!")
             print(f"Outline: {book.outline.status}")
             print(f"Chapters: {len(book.chapters)}")
+            print("\n--- COST & LATENCY ---")
+            metrics.print_book_report(session, book.id)
             input("Press Enter to return to menu...")
             break
         
@@ -116,6 +156,30 @@ def manage_book(session, book_id):
         if cont.lower() != 'y':
             break
 
+def pick_candidate(session, rows):
+    """Lists the stored alternatives (best-ranked first) and lets the editor pick one."""
+    for row in rows:
+        marker = " (current)" if row.selected else ""
+        print(f"\n--- CANDIDATE {row.rank}{marker}: T={row.temperature:.2f}, score {row.score:.2f} ---")
+        print(row.content[:300] + "...")
+    try:
+        rank = int(input("\nUse candidate # (0 to keep current): "))
+    except ValueError:
+        print("Invalid selection.")
+        return
+    picked = next((row for row in rows if row.rank == rank), None)
+    if picked:
+        candidates.select_candidate(session, picked.id)
+
+def offer_stuck_reset(session, obj):
+    """Generating elsewhere; a stale claim (killed process) can be reset from here."""
+    if not state_machine.is_stale_claim(obj):
+        print("This is being generated in another session. Check back shortly.")
+        return
+    print(f"Generation started over {state_machine.CLAIM_TIMEOUT} ago and looks abandoned.")
+    if input("Reset it so it can be generated again? (y/n): ").lower() == "y":
+        state_machine.release(session, obj)
+
 def handle_planning_phase(session, book):
     if not book.outline:
         print("Error: No outline found despite being in PLANNING.")
@@ -125,9 +189,13 @@ def handle_planning_phase(session, book):
     print(book.outline.content)
     print("-" * 30)
     
+    if book.outline.status == "generating":
+        offer_stuck_reset(session, book.outline)
+        return
+    
     if book.outline.status == "approved":
         # Should have moved to WRITING_CHAPTERS, but update if stuck
-        book.status = "WRITING_CHAPTERS"
+        state_machine.transition(session, book, "WRITING_CHAPTERS")
         session.commit()
         return
 
@@ -135,13 +203,16 @@ def handle_planning_phase(session, book):
     print("1. Approve Outline")
     print("2. Request Changes (Add Notes)")
     print("3. Regenerate entirely")
+    rows = candidates.list_candidates(session, book.id)
+    if rows:
+        print(f"4. Compare candidates ({len(rows)})")
     
     choice = input("Choice: ")
     
     if choice == "1":
-        outline.approve_outline(session, book.id)
-        notifications.send_notification("Outline Approved. Parsing chapters...")
-        chapter.parse_chapters_from_outline(session, book.id)
+        if outline.approve_outline(session, book.id):
+            notifications.send_notification("Outline Approved. Parsing chapters...")
+            chapter.parse_chapters_from_outline(session, book.id)
     elif choice == "2":
         notes = input("Enter feedback notes: ")
         notifications.send_notification("Regenerating outline with feedback...")
@@ -150,6 +221,8 @@ def handle_planning_phase(session, book):
         # Simple regeneration
         print("Regenerating...")
         outline.create_initial_outline(session, book.id, "Regenerate from scratch")
+    elif choice == "4" and rows:
+        pick_candidate(session, rows)
 
 def handle_writing_phase(session, book):
     # Check for pending chapters
@@ -183,11 +256,17 @@ def handle_writing_phase(session, book):
             chapter.generate_next_chapter(session, book.id, notes)
         elif opt == 'skip':
             # Manual skip/hack if needed
-            current_chapter.status = "APPROVED" # Dangerous but useful for debugging
-            current_chapter.content = "Skipped"
-            current_chapter.summary = "Chapter was skipped."
+            # Dangerous but useful for debugging
+            state_machine.transition(
+                session, current_chapter, "APPROVED",
+                content="Skipped",
+                summary="Chapter was skipped."
+            )
             session.commit()
             
+    elif current_chapter.status == "GENERATING":
+        offer_stuck_reset(session, current_chapter)
+            
     elif current_chapter.status in ["WAITING_FOR_REVIEW", "DRAFT"]:
         print("\n--- CONTENT PREVIEW (First 500 chars) ---")
         print(current_chapter.content[:500] + "...\n")
@@ -196,6 +275,10 @@ def handle_writing_phase(session, book):
         print("1. Approve & Continue")
         print("2. Request Changes (Regenerate with Notes)")
         print("3. Edit manually (Not implemented in CLI)")
+        print("4. Rewrite a section (paragraph range)")
+        rows = candidates.list_candidates(session, book.id, current_chapter.id)
+        if rows:
+            print(f"5. Compare candidates ({len(rows)})")
         
         choice = input("Choice: ")
         
@@ -205,6 +288,16 @@ def handle_writing_phase(session, book):
         elif choice == "2":
             notes = input("Enter feedback notes: ")
             chapter.regenerate_chapter(session, current_chapter.id, notes)
+        elif choice == "4":
+            try:
+                start = int(input("First paragraph #: "))
+                end = int(input("Last paragraph #: "))
+                notes = input("Enter feedback notes: ")
+                chapter.regenerate_section(session, current_chapter.id, notes, start, end)
+            except ValueError as e:
+                print(f"Invalid section: {e}")
+        elif choice == "5" and rows:
+            pick_candidate(session, rows)
 
 if __name__ == "__main__":
     init_db()
@@ -217,4 +310,6 @@ if __name__ == "__main__":
         print("The system will likely error out on LLM calls otherwise.\n")
     
     with get_session() as session:
+        duplicates.backfill(session) # Chapters approved before the duplicate index existed
+        changes.sync(session) # Start the change-feed cursor before anything is loaded
         main_menu(session)
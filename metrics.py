@@ -0,0 +1,283 @@
+import atexit
+import contextvars
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import event, insert, select, func, case
+from sqlalchemy.orm import Session
+
+import db
+from db import MetricEvent
+
+logger = logging.getLogger(__name__)
+
+# Spans are buffered in memory and written in batches by a background thread,
+# so recording one never waits on the database (or on a write lock held by the
+# caller's own transaction). The buffer is flushed when it fills up, every
+# FLUSH_INTERVAL seconds, before any report is built, and at interpreter exit.
+# A failed write puts the rows back, so token usage is never lost to a busy DB.
+FLUSH_EVERY = 50
+FLUSH_INTERVAL = 10.0
+MAX_BUFFER = 100_000 # Safety cap if the database stays unwritable
+
+# USD per 1M tokens, used for the cost columns of the per-book report
+PROMPT_COST_PER_1M = float(os.getenv("PROMPT_COST_PER_1M", "0.10"))
+COMPLETION_COST_PER_1M = float(os.getenv("COMPLETION_COST_PER_1M", "0.50"))
+
+_context = contextvars.ContextVar("metrics_context", default={})
+_buffer = []
+_inflight = [] # Rows taken out of the buffer by a flush that hasn't committed yet
+_buffer_lock = threading.Lock()
+_engine = None
+_wake = threading.Event()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+def configure(engine):
+    """Write metrics through `engine` instead of the app's default one (e.g. in loadtest.py)."""
+    global _engine
+    _engine = engine
+
+class Span:
+    """A timed stage. Token usage can be attached before it ends."""
+
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.prompt_tokens = None
+        self.completion_tokens = None
+
+    def record_usage(self, usage):
+        """Copies token counts from a chat completion's `usage` object, if any."""
+        if usage is None:
+            return
+        self.prompt_tokens = getattr(usage, "prompt_tokens", None)
+        self.completion_tokens = getattr(usage, "completion_tokens", None)
+
+@contextmanager
+def bind(**attrs):
+    """Attaches attributes (book_id, chapter_id) to every span started inside the block."""
+    token = _context.set({**_context.get(), **attrs})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+def propagate(fn):
+    """
+    Wraps `fn` so it runs with the caller's bound attributes when submitted to a
+    thread pool (context variables are not inherited by worker threads).
+    """
+    ctx = contextvars.copy_context()
+    def run(*args, **kwargs):
+        return ctx.copy().run(fn, *args, **kwargs)
+    return run
+
+@contextmanager
+def span(name: str, **attrs):
+    """Times the enclosed block and records it as one metric event."""
+    current = Span(name, {**_context.get(), **attrs})
+    started_at = datetime.utcnow()
+    start = time.perf_counter()
+    status = "ok"
+    try:
+        yield current
+    except Exception:
+        status = "error"
+        raise
+    finally:
+        _record(current, started_at, time.perf_counter() - start, status)
+
+def _record(current: Span, started_at: datetime, seconds: float, status: str):
+    row = {
+        "name": current.name,
+        "book_id": current.attrs.get("book_id"),
+        "chapter_id": current.attrs.get("chapter_id"),
+        "started_at": started_at,
+        "duration_ms": seconds * 1000,
+        "prompt_tokens": current.prompt_tokens,
+        "completion_tokens": current.completion_tokens,
+        "status": status,
+        "prompt_version": current.attrs.get("prompt_version"),
+    }
+    with _buffer_lock:
+        _buffer.append(row)
+        due = len(_buffer) >= FLUSH_EVERY
+    _start_flusher()
+    if due:
+        _wake.set()
+
+def _start_flusher():
+    global _flusher
+    if _flusher is not None:
+        return
+    with _flusher_lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_flush_loop, name="metrics-flusher", daemon=True)
+            _flusher.start()
+
+def _flush_loop():
+    while True:
+        _wake.wait(FLUSH_INTERVAL)
+        _wake.clear()
+        if not flush():
+            time.sleep(FLUSH_INTERVAL) # Back off while the database is unavailable
+
+def _forget_inflight(rows):
+    ids = {id(r) for r in rows}
+    _inflight[:] = [r for r in _inflight if id(r) not in ids]
+
+def flush() -> bool:
+    """
+    Writes buffered spans to the metric_events table. On failure the rows go
+    back into the buffer for the next attempt and False is returned.
+    """
+    with _buffer_lock:
+        rows = _buffer[:]
+        _buffer.clear()
+        _inflight.extend(rows)
+    if not rows:
+        return True
+    try:
+        # Plain Core transaction: doesn't go through Session events, so it isn't traced itself
+        with (_engine or db.engine).begin() as conn:
+            conn.execute(insert(MetricEvent), rows)
+        with _buffer_lock:
+            _forget_inflight(rows)
+        return True
+    except Exception as e:
+        with _buffer_lock:
+            _forget_inflight(rows)
+            _buffer[:0] = rows
+            overflow = len(_buffer) - MAX_BUFFER
+            if overflow > 0:
+                # Oldest non-LLM spans go first; token usage is kept as long as possible
+                timings = [i for i, r in enumerate(_buffer) if not r["name"].startswith("llm.")][:overflow]
+                for i in reversed(timings):
+                    del _buffer[i]
+        logger.warning(f"Metric flush failed, keeping {len(rows)} events for the next attempt: {e}")
+        return False
+
+def pending_usage(book_id: int, chapter_id: Optional[int] = None):
+    """(prompt, completion) tokens of llm.* spans not yet committed to metric_events."""
+    with _buffer_lock:
+        rows = [
+            r for r in _buffer + _inflight
+            if r["name"].startswith("llm.") and r["book_id"] == book_id
+            and (chapter_id is None or r["chapter_id"] == chapter_id)
+        ]
+    return (sum(r["prompt_tokens"] or 0 for r in rows), sum(r["completion_tokens"] or 0 for r in rows))
+
+atexit.register(flush)
+
+# --- Session commit spans ---
+
+@event.listens_for(Session, "before_commit")
+def _before_commit(session):
+    session.info["metrics_commit_start"] = (time.perf_counter(), datetime.utcnow())
+
+@event.listens_for(Session, "after_commit")
+def _after_commit(session):
+    started = session.info.pop("metrics_commit_start", None)
+    if started:
+        _record(Span("db.commit", dict(_context.get())), started[1], time.perf_counter() - started[0], "ok")
+
+@event.listens_for(Session, "after_rollback")
+def _after_rollback(session):
+    started = session.info.pop("metrics_commit_start", None)
+    if started:
+        _record(Span("db.commit", dict(_context.get())), started[1], time.perf_counter() - started[0], "error")
+
+# --- Reports ---
+
+def _aggregate(session: Session, book_id: Optional[int] = None):
+    # Each prompt version is its own row, so a reworded template starts fresh numbers
+    query = select(
+        MetricEvent.name,
+        MetricEvent.prompt_version,
+        func.count(MetricEvent.id).label("calls"),
+        func.sum(MetricEvent.duration_ms).label("duration_ms"),
+        func.coalesce(func.sum(MetricEvent.prompt_tokens), 0).label("prompt_tokens"),
+        func.coalesce(func.sum(MetricEvent.completion_tokens), 0).label("completion_tokens"),
+        func.sum(case((MetricEvent.status == "error", 1), else_=0)).label("errors"),
+    ).group_by(MetricEvent.name, MetricEvent.prompt_version).order_by(MetricEvent.name, MetricEvent.prompt_version)
+    if book_id is not None:
+        query = query.where(MetricEvent.book_id == book_id)
+    return session.execute(query).all()
+
+def token_cost(prompt_tokens: int, completion_tokens: int) -> float:
+    """Estimated USD cost of the given token counts."""
+    return (prompt_tokens * PROMPT_COST_PER_1M + completion_tokens * COMPLETION_COST_PER_1M) / 1_000_000
+
+def book_report(session: Session, book_id: int) -> list:
+    """Per-stage calls, wall-clock seconds, tokens and estimated cost for one book."""
+    flush()
+    report = []
+    for row in _aggregate(session, book_id):
+        report.append({
+            "stage": f"{row.name} ({row.prompt_version})" if row.prompt_version else row.name,
+            "calls": row.calls,
+            "seconds": round((row.duration_ms or 0) / 1000, 2),
+            "prompt_tokens": row.prompt_tokens,
+            "completion_tokens": row.completion_tokens,
+            "cost_usd": round(token_cost(row.prompt_tokens, row.completion_tokens), 4),
+            "errors": row.errors,
+        })
+    return report
+
+def print_book_report(session: Session, book_id: int):
+    report = book_report(session, book_id)
+    if not report:
+        print("No metrics recorded for this book yet.")
+        return
+    print(f"{'stage':<24}{'calls':>7}{'seconds':>10}{'prompt':>10}{'completion':>12}{'cost $':>10}")
+    for r in report:
+        print(f"{r['stage']:<24}{r['calls']:>7}{r['seconds']:>10.2f}{r['prompt_tokens']:>10}{r['completion_tokens']:>12}{r['cost_usd']:>10.4f}")
+    print(f"{'TOTAL':<24}{sum(r['calls'] for r in report):>7}{sum(r['seconds'] for r in report):>10.2f}"
+          f"{sum(r['prompt_tokens'] for r in report):>10}{sum(r['completion_tokens'] for r in report):>12}"
+          f"{sum(r['cost_usd'] for r in report):>10.4f}")
+
+def _labels(row, **extra) -> str:
+    labels = {"stage": row.name, **({"prompt": row.prompt_version} if row.prompt_version else {}), **extra}
+    return ",".join(f'{key}="{value}"' for key, value in labels.items())
+
+def prometheus_text(session: Session) -> str:
+    """All-time span metrics in the Prometheus text exposition format."""
+    flush()
+    rows = _aggregate(session)
+    lines = [
+        "# HELP bookgen_span_duration_seconds Wall-clock time spent per stage.",
+        "# TYPE bookgen_span_duration_seconds summary",
+    ]
+    for r in rows:
+        lines.append(f'bookgen_span_duration_seconds_count{{{_labels(r)}}} {r.calls}')
+        lines.append(f'bookgen_span_duration_seconds_sum{{{_labels(r)}}} {(r.duration_ms or 0) / 1000:.6f}')
+    lines += [
+        "# HELP bookgen_tokens_total LLM tokens used per stage.",
+        "# TYPE bookgen_tokens_total counter",
+    ]
+    for r in rows:
+        if r.prompt_tokens or r.completion_tokens:
+            lines.append(f'bookgen_tokens_total{{{_labels(r, kind="prompt")}}} {r.prompt_tokens}')
+            lines.append(f'bookgen_tokens_total{{{_labels(r, kind="completion")}}} {r.completion_tokens}')
+    lines += [
+        "# HELP bookgen_span_errors_total Failed calls per stage.",
+        "# TYPE bookgen_span_errors_total counter",
+    ]
+    for r in rows:
+        lines.append(f'bookgen_span_errors_total{{{_labels(r)}}} {r.errors}')
+    return "\n".join(lines) + "\n"
+
+def export_prometheus(session: Session, path: str = "metrics.prom") -> str:
+    """Writes prometheus_text() to `path` (e.g. for node_exporter's textfile collector)."""
+    # Write-then-rename so a scraper never sees a half-written file
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(prometheus_text(session))
+    os.replace(tmp_path, path)
+    return path
@@ -0,0 +1,187 @@
+"""
+Library export/import.
+
+Archives are gzip-compressed JSON Lines. The first line is a header, then for
+each book: one "book" record, an optional "outline" record and its "chapter"
+records. Everything is read and written in fixed-size batches, so memory use
+does not depend on library size, and each batch is its own short transaction
+so the SQLite file is never locked for long.
+"""
+import gzip
+import json
+import uuid
+from datetime import datetime
+from typing import Iterable, Optional
+
+from sqlalchemy import select, insert
+from sqlalchemy.orm import Session
+from db import Book, Outline, Chapter, ImportJob
+from modules import duplicates, changes
+
+FORMAT_NAME = "bookgen-archive"
+FORMAT_VERSION = 2 # 2: books carry their budget settings
+BATCH_SIZE = 500
+
+# In-flight claims are not meaningful on another host; import them as reviewable drafts
+_IMPORT_STATUS_FIXUPS = {"GENERATING": "DRAFT", "generating": "waiting_for_review"}
+
+_BOOK_FIELDS = ("id", "title", "status", "created_at", "token_budget", "budget_mode", "target_words")
+_OUTLINE_FIELDS = ("book_id", "content", "status", "editor_notes")
+_CHAPTER_FIELDS = ("book_id", "chapter_number", "title", "content", "summary", "status", "editor_notes")
+
+def _row_to_record(kind: str, row, fields) -> dict:
+    record = {"type": kind}
+    for field in fields:
+        value = getattr(row, field)
+        record[field] = value.isoformat() if isinstance(value, datetime) else value
+    return record
+
+def _iter_book_rows(session: Session, book_ids: Optional[Iterable[int]]):
+    """Keyset-paginates books so no read transaction outlives one batch."""
+    last_id = 0
+    wanted = sorted(set(book_ids)) if book_ids else None
+    while True:
+        query = select(*[getattr(Book, f) for f in _BOOK_FIELDS]).where(Book.id > last_id)
+        if wanted is not None:
+            query = query.where(Book.id.in_(wanted))
+        rows = session.execute(query.order_by(Book.id).limit(BATCH_SIZE)).all()
+        session.commit()  # End the read transaction between batches
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+def _iter_chapter_rows(session: Session, book_id: int):
+    last_id = 0
+    columns = [Chapter.id] + [getattr(Chapter, f) for f in _CHAPTER_FIELDS]
+    while True:
+        rows = session.execute(
+            select(*columns)
+            .where(Chapter.book_id == book_id, Chapter.id > last_id)
+            .order_by(Chapter.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        session.commit()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1].id
+
+def export_library(session: Session, path: str, book_ids: Optional[Iterable[int]] = None) -> int:
+    """
+    Streams the whole library (or only `book_ids`) to a .jsonl.gz archive.
+    Returns the number of books written.
+    """
+    book_count = 0
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        header = {
+            "type": "header",
+            "format": FORMAT_NAME,
+            "version": FORMAT_VERSION,
+            "export_id": uuid.uuid4().hex,
+            "exported_at": datetime.utcnow().isoformat(),
+        }
+        f.write(json.dumps(header) + "\n")
+
+        for book_row in _iter_book_rows(session, book_ids):
+            f.write(json.dumps(_row_to_record("book", book_row, _BOOK_FIELDS)) + "\n")
+
+            outline_row = session.execute(
+                select(*[getattr(Outline, field) for field in _OUTLINE_FIELDS]).where(Outline.book_id == book_row.id)
+            ).first()
+            if outline_row:
+                f.write(json.dumps(_row_to_record("outline", outline_row, _OUTLINE_FIELDS)) + "\n")
+
+            for chapter_row in _iter_chapter_rows(session, book_row.id):
+                f.write(json.dumps(_row_to_record("chapter", chapter_row, _CHAPTER_FIELDS)) + "\n")
+            book_count += 1
+
+    print(f"Exported {book_count} books to: {path}")
+    return book_count
+
+def _read_header(path: str) -> dict:
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        header = json.loads(f.readline())
+    if header.get("type") != "header" or header.get("format") != FORMAT_NAME:
+        raise ValueError(f"{path} is not a book library archive")
+    if header.get("version", 0) > FORMAT_VERSION:
+        raise ValueError(f"Archive version {header['version']} is newer than supported ({FORMAT_VERSION})")
+    return header
+
+def import_library(session: Session, path: str) -> int:
+    """
+    Imports an archive written by export_library() using batched inserts.
+
+    Progress is checkpointed in the `import_jobs` table in the same transaction
+    as each batch, so an interrupted import resumes where it stopped when run
+    again with the same archive. Returns the number of books imported.
+    """
+    header = _read_header(path)
+    job = session.execute(
+        select(ImportJob).where(ImportJob.export_id == header["export_id"])
+    ).scalar_one_or_none()
+    if job and job.finished:
+        print(f"Archive {path} was already imported.")
+        return 0
+    if not job:
+        job = ImportJob(export_id=header["export_id"], source=path, lines_done=1)
+        session.add(job)
+        session.commit()
+    elif job.lines_done > 1:
+        print(f"Resuming import of {path} from line {job.lines_done + 1}...")
+
+    current_book_id = job.current_book_id
+    books_imported = 0
+    chapter_batch = []
+    pending_lines = 0
+
+    def checkpoint(line_no: int):
+        nonlocal chapter_batch, pending_lines
+        if chapter_batch:
+            session.execute(insert(Chapter), chapter_batch)
+        job.lines_done = line_no
+        job.current_book_id = current_book_id
+        session.commit()
+        chapter_batch = []
+        pending_lines = 0
+
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        line_no = 0
+        for line_no, line in enumerate(f, start=1):
+            if line_no <= job.lines_done:
+                continue
+            record = json.loads(line)
+            kind = record.pop("type")
+            if "status" in record:
+                record["status"] = _IMPORT_STATUS_FIXUPS.get(record["status"], record["status"])
+
+            if kind == "book":
+                # Flush the previous book's chapters before switching target ids
+                checkpoint(line_no - 1)
+                record.pop("id")
+                if record.get("created_at"):
+                    record["created_at"] = datetime.fromisoformat(record["created_at"])
+                current_book_id = session.execute(insert(Book).values(**record)).inserted_primary_key[0]
+                changes.record(session, session.get(Book, current_book_id), "created")
+                books_imported += 1
+            elif kind == "outline":
+                record["book_id"] = current_book_id
+                session.execute(insert(Outline).values(**record))
+            elif kind == "chapter":
+                record["book_id"] = current_book_id
+                chapter_batch.append(record)
+            else:
+                print(f"[WARNING] Skipping unknown record type '{kind}' on line {line_no}")
+
+            pending_lines += 1
+            if pending_lines >= BATCH_SIZE:
+                checkpoint(line_no)
+
+        checkpoint(line_no)
+
+    job.finished = True
+    session.commit()
+    # Imported approved chapters go into the duplicate index like any other
+    duplicates.backfill(session)
+    print(f"Imported {books_imported} books from: {path}")
+    return books_imported
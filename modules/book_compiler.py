@@ -1,39 +1,55 @@
 from sqlalchemy.orm import Session
 from db import Book
+from modules import state_machine
+import metrics
 import os
 
 def compile_book(session: Session, book_id: int):
-    """Compiles all chapters into a single file."""
+    """
+    Compiles all chapters into a single file and marks the book COMPLETED.
+    Returns None (and writes nothing) if the book isn't ready to be compiled.
+    """
     book = session.get(Book, book_id)
     if not book:
         return
+    if not state_machine.can_transition(Book, book.status, "COMPLETED"):
+        print(f"Book is '{book.status}'; approve its outline and chapters before compiling.")
+        return None
 
     # Check if all chapters are approved
     # (In loose mode, we might allow compiling drafts, but let's be strict for now or warn)
     
     filename = f"{book.title.replace(' ', '_')}_Final.txt"
     filepath = os.path.join(os.getcwd(), filename)
+    # Written aside and only moved into place once the status change went through
+    tmp_path = filepath + ".tmp"
     
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.write(f"Title: {book.title}\n")
-        f.write("Generated by AI Book Agent\n")
-        f.write("="*30 + "\n\n")
+    with metrics.bind(book_id=book_id), metrics.span("compile.book"):
+        with metrics.span("compile.write"), open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(f"Title: {book.title}\n")
+            f.write("Generated by AI Book Agent\n")
+            f.write("="*30 + "\n\n")
         
-        # Write Outline
-        if book.outline:
-            f.write("OUTLINE\n")
-            f.write(book.outline.content)
-            f.write("\n\n" + "="*30 + "\n\n")
+            # Write Outline
+            if book.outline:
+                f.write("OUTLINE\n")
+                f.write(book.outline.content)
+                f.write("\n\n" + "="*30 + "\n\n")
         
-        # Write Chapters
-        for ch in book.chapters:
-            f.write(f"CHAPTER {ch.chapter_number}: {ch.title}\n")
-            f.write("-" * 20 + "\n")
-            f.write(ch.content if ch.content else "[No Content]")
-            f.write("\n\n" + "#" * 10 + "\n\n")
+            # Write Chapters
+            for ch in book.chapters:
+                f.write(f"CHAPTER {ch.chapter_number}: {ch.title}\n")
+                f.write("-" * 20 + "\n")
+                f.write(ch.content if ch.content else "[No Content]")
+                f.write("\n\n" + "#" * 10 + "\n\n")
             
-    book.status = "COMPLETED"
-    session.commit()
+        if not state_machine.transition(session, book, "COMPLETED"):
+            session.rollback()
+            os.remove(tmp_path)
+            print("Book changed in another session while compiling; please try again.")
+            return None
+        os.replace(tmp_path, filepath)
+        session.commit()
     
     print(f"Book compiled successfully to: {filepath}")
     return filepath
@@ -0,0 +1,126 @@
+import os
+from typing import Optional, Tuple
+
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+
+from db import Book, Chapter, MetricEvent
+import metrics
+
+# Per-book token budgets. Actual usage comes from the llm.* spans recorded by
+# metrics.py, so it reflects what the provider reported, retries included.
+# Budgets are set per book (Book.token_budget); these env vars are defaults.
+DEFAULT_BUDGET = int(os.getenv("BOOK_TOKEN_BUDGET", "0")) or None
+DEFAULT_MODE = os.getenv("BOOK_BUDGET_MODE", "warn") # warn | hard
+DEFAULT_TARGET_WORDS = int(os.getenv("BOOK_TARGET_WORDS", "0")) or None
+
+MIN_MAX_TOKENS = 512
+TOKENS_PER_WORD = 1.35
+LENGTH_HEADROOM = 1.2 # Room above the target so chapters aren't cut mid-sentence
+DEFAULT_PROMPT_TOKENS = 2000 # Prompt estimate before any chapter has been generated
+DEFAULT_MAX_TOKENS = 6000 # llm_client's chapter cap when none is given
+
+def book_budget(book: Book) -> Optional[int]:
+    return book.token_budget or DEFAULT_BUDGET
+
+def book_mode(book: Book) -> str:
+    return book.budget_mode or DEFAULT_MODE
+
+def book_target_words(book: Book) -> Optional[int]:
+    return book.target_words or DEFAULT_TARGET_WORDS
+
+def _usage(session: Session, book_id: int, chapter_id: Optional[int] = None):
+    """
+    (prompt, completion) tokens recorded for a book or one of its chapters:
+    stored rows plus the spans the background flusher hasn't written yet, so
+    checking a budget never waits on a metrics write and never misses spend.
+    """
+    # Read before the query: a row flushed in between is then counted twice
+    # at worst, never missed
+    pending = metrics.pending_usage(book_id, chapter_id)
+    query = select(
+        func.coalesce(func.sum(MetricEvent.prompt_tokens), 0),
+        func.coalesce(func.sum(MetricEvent.completion_tokens), 0),
+    ).where(MetricEvent.book_id == book_id, MetricEvent.name.like("llm.%"))
+    if chapter_id is not None:
+        query = query.where(MetricEvent.chapter_id == chapter_id)
+    stored = session.execute(query).one()
+    return (stored[0] + pending[0], stored[1] + pending[1])
+
+def tokens_used(session: Session, book_id: int, chapter_id: Optional[int] = None) -> int:
+    """Prompt + completion tokens recorded for a book (or one of its chapters)."""
+    return sum(_usage(session, book_id, chapter_id))
+
+def _average_prompt_tokens(session: Session, book_id: int) -> int:
+    avg = session.execute(
+        select(func.avg(MetricEvent.prompt_tokens))
+        .where(MetricEvent.book_id == book_id, MetricEvent.name == "llm.chapter")
+    ).scalar_one()
+    return int(avg) if avg else DEFAULT_PROMPT_TOKENS
+
+def status(session: Session, book: Book) -> dict:
+    """Budget, usage and remaining tokens for a book."""
+    budget = book_budget(book)
+    prompt_tokens, completion_tokens = _usage(session, book.id)
+    used = prompt_tokens + completion_tokens
+    remaining = budget - used if budget else None
+    return {
+        "budget": budget,
+        "used": used,
+        "remaining": remaining,
+        "mode": book_mode(book),
+        "exceeded": budget is not None and used >= budget,
+        "cost_usd": round(metrics.token_cost(prompt_tokens, completion_tokens), 4),
+    }
+
+def check(session: Session, book: Book) -> bool:
+    """
+    Returns False if the book is over a hard budget and generation must stop.
+    Over a "warn" budget it only prints a warning.
+    """
+    current = status(session, book)
+    if not current["exceeded"]:
+        return True
+    message = f"Token budget for '{book.title}' exceeded: {current['used']}/{current['budget']} tokens."
+    if current["mode"] == "hard":
+        print(f"[BUDGET] {message} Generation stopped.")
+        return False
+    print(f"[BUDGET WARNING] {message}")
+    return True
+
+def chapter_limits(session: Session, book: Book, best_of: int = 1) -> Tuple[Optional[int], bool]:
+    """
+    Completion cap for the next chapter call, from the target book length
+    (evenly split across chapters) and the remaining budget (split across
+    the chapters still to be approved and the best_of drafts of this one,
+    minus their expected prompt size).
+    Returns (cap, budget_bound): cap is None if the book has neither a budget
+    nor a target length; budget_bound is True when the budget, not the target
+    length, sets the cap, i.e. a retry would only spend more of a scarce budget.
+    """
+    length_limit = budget_limit = None
+
+    total_chapters = session.execute(
+        select(func.count(Chapter.id)).where(Chapter.book_id == book.id)
+    ).scalar_one()
+    target_words = book_target_words(book)
+    if target_words and total_chapters:
+        length_limit = int(target_words / total_chapters * TOKENS_PER_WORD * LENGTH_HEADROOM)
+
+    budget = book_budget(book)
+    if budget:
+        remaining_chapters = session.execute(
+            select(func.count(Chapter.id)).where(Chapter.book_id == book.id, Chapter.status != "APPROVED")
+        ).scalar_one() or 1
+        remaining = budget - tokens_used(session, book.id)
+        budget_limit = remaining // remaining_chapters // max(1, best_of) - _average_prompt_tokens(session, book.id)
+
+    limits = [limit for limit in (length_limit, budget_limit) if limit is not None]
+    if not limits:
+        return None, False
+    budget_bound = budget_limit is not None and budget_limit < (length_limit or DEFAULT_MAX_TOKENS)
+    return max(MIN_MAX_TOKENS, min(limits)), budget_bound
+
+def chapter_max_tokens(session: Session, book: Book, best_of: int = 1) -> Optional[int]:
+    """Completion cap for the next chapter call (see chapter_limits)."""
+    return chapter_limits(session, book, best_of)[0]
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional
+
+from sqlalchemy import select, delete, update
+from sqlalchemy.orm import Session
+
+from db import Book, Chapter, Candidate
+from modules import state_machine, quality
+import metrics
+import prompts
+
+# Best-of-N drafting. Instead of one outline/chapter per round, N candidates
+# are requested concurrently (optionally spread over a range of temperatures),
+# pre-ranked by a cheap local scorer and stored as alternatives. The best one
+# becomes the outline/chapter content; the editor can switch to any other in
+# the review view. N parallel calls cost N times the tokens but only one wait,
+# which saves whole review rounds.
+DEFAULT_COUNT = int(os.getenv("CANDIDATE_COUNT", "1"))
+MAX_COUNT = 5
+TEMPERATURE_SPREAD = float(os.getenv("CANDIDATE_TEMPERATURE_SPREAD", "0.2"))
+
+def count(best_of: Optional[int] = None) -> int:
+    """Number of candidates to draft (CANDIDATE_COUNT by default, capped at MAX_COUNT)."""
+    return max(1, min(MAX_COUNT, best_of or DEFAULT_COUNT))
+
+def temperatures(n: int, base: float, vary: bool = True) -> List[float]:
+    """n temperatures evenly spread over base ± TEMPERATURE_SPREAD (all `base` if not varied)."""
+    if n <= 1 or not vary:
+        return [base] * max(1, n)
+    step = 2 * TEMPERATURE_SPREAD / (n - 1)
+    return [round(min(1.5, max(0.1, base - TEMPERATURE_SPREAD + i * step)), 2) for i in range(n)]
+
+def draft(generate: Callable[[float], str], temps: List[float]) -> List[str]:
+    """Calls generate(temperature) once per temperature, concurrently."""
+    if len(temps) == 1:
+        return [generate(temps[0])]
+    with ThreadPoolExecutor(max_workers=len(temps)) as pool:
+        return list(pool.map(metrics.propagate(generate), temps))
+
+# --- Local scorers (higher is better) ---
+
+def score_outline(content: str) -> float:
+    """Parseable into chapters, every chapter described, numbered in order; errors score lowest."""
+    if quality.check_error_signature(content, None):
+        return -1.0
+    entries = prompts.split_outline(content)
+    if not entries:
+        return 0.0
+    described = sum(1 for heading, text in entries if text != heading) / len(entries)
+    numbers = [int(next(g for g in prompts.CHAPTER_HEADING.match(heading).groups() if g)) for heading, _ in entries]
+    in_order = numbers == list(range(1, len(numbers) + 1))
+    return 1.0 + described + (0.5 if in_order else 0.0)
+
+def score_chapter(content: str, problems: List[str]) -> float:
+    """Fewest quality-gate problems first, then least repetition."""
+    return -len(problems) - quality.repetition_ratio(content or "")
+
+# --- Storage ---
+
+def _target(query, book_id: int, chapter_id: Optional[int]):
+    return query.where(
+        Candidate.book_id == book_id,
+        Candidate.chapter_id == chapter_id if chapter_id is not None else Candidate.chapter_id.is_(None),
+    )
+
+def store(session: Session, book_id: int, chapter_id: Optional[int], kind: str, entries: List[dict]) -> dict:
+    """
+    Replaces the stored candidates for an outline (chapter_id None) or chapter
+    with `entries` (dicts with content, temperature, score and optional notes),
+    ranked by score. A single entry is not stored, since there's nothing to pick.
+    Returns the best entry. The caller commits.
+    """
+    clear(session, book_id, chapter_id)
+    ranked = sorted(entries, key=lambda e: -e["score"])
+    if len(ranked) > 1:
+        session.add_all([
+            Candidate(
+                book_id=book_id,
+                chapter_id=chapter_id,
+                kind=kind,
+                content=entry["content"],
+                temperature=entry["temperature"],
+                score=round(entry["score"], 3),
+                rank=rank,
+                notes=entry.get("notes"),
+                selected=rank == 1,
+            )
+            for rank, entry in enumerate(ranked, start=1)
+        ])
+    return ranked[0]
+
+def list_candidates(session: Session, book_id: int, chapter_id: Optional[int] = None) -> List[Candidate]:
+    """Stored alternatives for the book's outline (or one chapter), best first."""
+    return session.execute(_target(select(Candidate), book_id, chapter_id).order_by(Candidate.rank)).scalars().all()
+
+def clear(session: Session, book_id: int, chapter_id: Optional[int] = None):
+    """Drops the alternatives once a round is over (approval, new round). The caller commits."""
+    session.execute(_target(delete(Candidate), book_id, chapter_id).execution_options(synchronize_session="fetch"))
+
+def remove_book(session: Session, book_id: int):
+    """Drops a deleted book's candidates. The caller commits."""
+    session.execute(delete(Candidate).where(Candidate.book_id == book_id).execution_options(synchronize_session="fetch"))
+
+def select_candidate(session: Session, candidate_id: int) -> bool:
+    """Makes a stored candidate the outline/chapter under review."""
+    candidate = session.get(Candidate, candidate_id)
+    if not candidate:
+        raise ValueError("Candidate not found")
+
+    if candidate.kind == "outline":
+        target = session.get(Book, candidate.book_id).outline
+        values = {"content": candidate.content}
+        reviewable = ("waiting_for_review",)
+    else:
+        target = session.get(Chapter, candidate.chapter_id)
+        values = {"content": candidate.content, "editor_notes": candidate.notes or ""}
+        reviewable = ("WAITING_FOR_REVIEW", "DRAFT")
+
+    if target is None or target.status not in reviewable:
+        print(f"The {candidate.kind} is no longer under review; candidate {candidate.rank} can't be picked.")
+        return False
+    if not state_machine.update_if_unchanged(session, target, target.version, **values):
+        session.rollback()
+        print(f"The {candidate.kind} changed in another session; please review it again.")
+        return False
+    session.execute(
+        _target(update(Candidate), candidate.book_id, candidate.chapter_id)
+        .values(selected=Candidate.id == candidate.id)
+    )
+    session.commit()
+    print(f"Picked candidate {candidate.rank} for the {candidate.kind}.")
+    return True
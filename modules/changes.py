@@ -0,0 +1,76 @@
+from typing import List, Optional, Tuple
+
+from sqlalchemy import select, insert, func
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.util import identity_key
+
+from db import Book, Outline, Chapter, ChangeEvent
+
+# Change feed. Every status/content change of a book, outline or chapter
+# appends a row to change_events in the same transaction as the change itself
+# (state_machine.transition / update_if_unchanged do this for all callers), so
+# an event is visible exactly when the change is. Sequence numbers only grow:
+# a client keeps the last seq it has seen and asks for what came after it,
+# then reloads just the affected objects instead of everything.
+ENTITIES = {Book: "book", Outline: "outline", Chapter: "chapter"}
+MODELS = {entity: model for model, entity in ENTITIES.items()}
+POLL_LIMIT = 500
+
+def record(session: Session, obj, kind: str, status: Optional[str] = None):
+    """
+    Appends an event (created / status / content / deleted) for a book, outline
+    or chapter. `status` defaults to the object's current status.
+    The caller is responsible for committing.
+    """
+    if obj.id is None:
+        session.flush() # New rows need their id first
+    entity = ENTITIES[type(obj)]
+    session.execute(insert(ChangeEvent).values(
+        book_id=obj.id if entity == "book" else obj.book_id,
+        chapter_id=obj.id if entity == "chapter" else None,
+        entity=entity,
+        entity_id=obj.id,
+        kind=kind,
+        status=status if status is not None else obj.status,
+    ))
+
+def latest(session: Session) -> int:
+    """Current end of the feed; a new client starts its cursor here."""
+    return session.execute(select(func.coalesce(func.max(ChangeEvent.seq), 0))).scalar_one()
+
+def poll(session: Session, after: int, book_id: Optional[int] = None, limit: int = POLL_LIMIT) -> list:
+    """Events with seq > after (optionally for one book), oldest first, as plain rows."""
+    query = select(ChangeEvent.__table__).where(ChangeEvent.seq > after)
+    if book_id is not None:
+        query = query.where(ChangeEvent.book_id == book_id)
+    return session.execute(query.order_by(ChangeEvent.seq).limit(limit)).all()
+
+def _expire(session: Session, model, obj_id: int, attributes: Optional[List[str]] = None):
+    obj = session.identity_map.get(identity_key(model, obj_id))
+    if obj is not None:
+        session.expire(obj, attributes)
+
+def refresh(session: Session, after: int, book_id: Optional[int] = None) -> Tuple[int, list]:
+    """
+    Expires only the objects this session has loaded that changed after
+    `after`, so their next access reloads them. Returns (new cursor, events).
+    """
+    events = poll(session, after, book_id)
+    for event in events:
+        _expire(session, MODELS[event.entity], event.entity_id)
+        if event.entity != "book":
+            # A new or changed child can leave the book's relationships stale
+            _expire(session, Book, event.book_id, ["outline", "chapters"])
+    return (events[-1].seq if events else after), events
+
+def sync(session: Session) -> list:
+    """
+    refresh() across all books with the cursor kept on the session itself
+    (session.info). The first call only sets the cursor.
+    """
+    cursor = session.info.get("change_cursor")
+    if cursor is None:
+        session.info["change_cursor"] = latest(session)
+        return []
+    session.info["change_cursor"], events = refresh(session, cursor)
+    return events
@@ -1,8 +1,10 @@
 from sqlalchemy.orm import Session
 from sqlalchemy import select
 from db import Book, Chapter
+from modules import state_machine, quality, budget, duplicates, candidates, changes
 import llm_client
-import re
+import metrics
+import prompts
 
 def parse_chapters_from_outline(session: Session, book_id: int):
     """
@@ -29,7 +31,8 @@ def parse_chapters_from_outline(session: Session, book_id: int):
     # Optional markdown (#, ##, **, etc)
     # The word "Chapter" (case insensitive) followed by a number
     # OR just a Number followed by a dot
-    pattern = re.compile(r'^(?:[#*]+\s*)?(?:chapter\s+(\d+)|(\d+)\.)', re.IGNORECASE)
+    # (shared with prompts.py, which windows the outline by the same headings)
+    pattern = prompts.CHAPTER_HEADING
 
     for line in lines:
         line = line.strip()
@@ -67,6 +70,7 @@ def parse_chapters_from_outline(session: Session, book_id: int):
                     status="PENDING"
                 )
                 session.add(new_chapter)
+                changes.record(session, new_chapter, "created")
     
     session.commit()
     print(f"Parsed {chapter_count} chapters from outline.")
@@ -76,8 +80,13 @@ def parse_chapters_from_outline(session: Session, book_id: int):
         print("Raw Outline Content (First 200 chars):")
         print(content[:200])
 
-def generate_next_chapter(session: Session, book_id: int, notes: str = ""):
-    """Finds the next pending chapter and generates it."""
+def generate_next_chapter(session: Session, book_id: int, notes: str = "", scene_mode: bool = None,
+                          best_of: int = None, vary_temperature: bool = True):
+    """
+    Finds the next pending chapter and generates it.
+    scene_mode drafts the chapter as parallel scenes (None = SCENE_DRAFTING env default).
+    best_of > 1 drafts that many candidates in parallel (default: CANDIDATE_COUNT env).
+    """
     book = session.get(Book, book_id)
     
     # Get all chapters sorted
@@ -90,7 +99,7 @@ def generate_next_chapter(session: Session, book_id: int, notes: str = ""):
         if ch.status == "APPROVED":
             if ch.summary:
                 previous_summaries.append(f"Chapter {ch.chapter_number} Summary: {ch.summary}")
-        elif ch.status in ["PENDING", "DRAFT", "WAITING_FOR_REVIEW"] and target_chapter is None:
+        elif target_chapter is None:
             target_chapter = ch
             # We found our target, but we keep iterating to build full context if we wanted, 
             # though usually we only need context UP TO this point.
@@ -100,42 +109,177 @@ def generate_next_chapter(session: Session, book_id: int, notes: str = ""):
         print("No pending chapters found. Book might be complete.")
         return None
 
-    print(f"Generating Chapter {target_chapter.chapter_number}: {target_chapter.title}...")
-    
     # Combine summaries
     context_str = "\n".join(previous_summaries)
     
-    content = llm_client.generate_chapter_content(
-        book.title,
-        target_chapter.title,
-        book.outline.content,
-        context_str,
-        notes
-    )
+    print(f"Generating Chapter {target_chapter.chapter_number}: {target_chapter.title}...")
+    return _write_chapter(session, book, target_chapter, context_str, notes, "", scene_mode, best_of, vary_temperature) # Reset notes
+
+def _write_chapter(session: Session, book: Book, chapter: Chapter, context_str: str, notes: str, editor_notes: str,
+                   scene_mode: bool = None, best_of: int = None, vary_temperature: bool = True):
+    """Claims the chapter, generates its content (or candidates) and puts it up for review."""
+    if not budget.check(session, book):
+        return None
+    best_of = candidates.count(best_of)
+    # With best_of drafts, each gets its share of the chapter's budget
+    max_tokens, budget_bound = budget.chapter_limits(session, book, best_of)
     
-    target_chapter.content = content
-    target_chapter.status = "WAITING_FOR_REVIEW"
-    target_chapter.editor_notes = "" # Reset notes
-    session.commit()
+    # Claim the chapter before paying for the LLM call. If another session
+    # (second tab, CLI) got there first, back off instead of generating twice.
+    # A chapter that is already GENERATING can't be claimed either.
+    previous_status = chapter.status
+    if not state_machine.claim(session, chapter, "GENERATING"):
+        print(f"Chapter {chapter.chapter_number} is already being generated elsewhere.")
+        return None
+    
+    with metrics.bind(book_id=book.id, chapter_id=chapter.id):
+        # Until the result is committed the claim is released on any exit,
+        # including Ctrl+C and a stopped Streamlit run
+        try:
+            if best_of > 1:
+                drafts = _draft_candidates(book, chapter, context_str, notes, scene_mode, max_tokens, best_of, vary_temperature)
+            else:
+                # A budget-capped draft would fail the gate the same way again; don't pay for retries
+                retries = 0 if budget_bound else quality.MAX_AUTO_RETRIES
+                content, problems = _generate_with_quality_gate(book, chapter, context_str, notes, scene_mode, max_tokens, retries)
+                drafts = [(content, problems, llm_client.CHAPTER_TEMPERATURE)]
+            
+            entries = [
+                {
+                    "content": content,
+                    "temperature": temperature,
+                    "problems": problems,
+                    "score": candidates.score_chapter(content, problems),
+                    "notes": _review_notes(session, chapter, content, problems, editor_notes),
+                }
+                for content, problems, temperature in drafts
+            ]
+            best = candidates.store(session, book.id, chapter.id, "chapter", entries)
+            if best["problems"]:
+                # Retries exhausted: still hand it to the editor, but say why it's suspect
+                print(f"[WARNING] Chapter {chapter.chapter_number} failed the quality gate: {' '.join(best['problems'])}")
+            
+            if not state_machine.transition(
+                session, chapter, "WAITING_FOR_REVIEW",
+                content=best["content"],
+                editor_notes=best["notes"],
+                claimed_at=None
+            ):
+                # Our claim expired and was reset by another session meanwhile
+                session.rollback()
+                print(f"Chapter {chapter.chapter_number} was reset while generating; the draft was discarded.")
+                return None
+            session.commit()
+        except BaseException:
+            _release_claim(session, chapter, previous_status)
+            raise
     
-    return target_chapter
+    return chapter
+
+def _review_notes(session: Session, chapter: Chapter, content: str, problems: list, editor_notes: str) -> str:
+    """Editor notes plus the quality-gate and near-duplicate warnings for a draft."""
+    if problems:
+        gate_note = "[Quality gate] " + " ".join(problems)
+        editor_notes = f"{editor_notes}\n{gate_note}" if editor_notes else gate_note
+    
+    # Flag passages recycled from approved chapters before the editor reads it
+    with metrics.span("duplicates.check"):
+        repeats = duplicates.find_duplicates(session, content, exclude_chapter_id=chapter.id)
+    if repeats:
+        repeat_note = "[Duplicates] Near-repeats of approved text: " + duplicates.describe_matches(session, repeats)
+        editor_notes = f"{editor_notes}\n{repeat_note}" if editor_notes else repeat_note
+    return editor_notes
+
+def _draft_candidates(book: Book, chapter: Chapter, context_str: str, notes: str, scene_mode: bool,
+                      max_tokens: int, best_of: int, vary_temperature: bool):
+    """
+    Drafts best_of chapters concurrently, one attempt each: the quality gate
+    ranks the candidates instead of triggering retries.
+    Returns [(content, problems, temperature)].
+    """
+    title, chapter_title, outline_content, number = book.title, chapter.title, book.outline.content, chapter.chapter_number
+    temps = candidates.temperatures(best_of, llm_client.CHAPTER_TEMPERATURE, vary_temperature)
+    contents = candidates.draft(
+        lambda temperature: llm_client.generate_chapter_content(
+            title, chapter_title, outline_content, context_str, notes,
+            scene_mode=scene_mode, max_tokens=max_tokens, chapter_number=number, temperature=temperature
+        ),
+        temps
+    )
+    drafts = []
+    for content, temperature in zip(contents, temps):
+        with metrics.span("quality.check"):
+            drafts.append((content, quality.run_checks(content, chapter), temperature))
+    return drafts
+
+def _generate_with_quality_gate(book: Book, chapter: Chapter, context_str: str, notes: str, scene_mode: bool = None,
+                               max_tokens: int = None, retries: int = None):
+    """
+    Generates the chapter and runs the local quality checks, regenerating up to
+    `retries` (default quality.MAX_AUTO_RETRIES) times so editors only see drafts that pass.
+    Returns (content, problems of the last attempt).
+    """
+    attempt_notes = notes
+    retries = quality.MAX_AUTO_RETRIES if retries is None else retries
+    for attempt in range(retries + 1):
+        content = llm_client.generate_chapter_content(
+            book.title,
+            chapter.title,
+            book.outline.content,
+            context_str,
+            attempt_notes,
+            scene_mode=scene_mode,
+            max_tokens=max_tokens,
+            chapter_number=chapter.chapter_number
+        )
+        with metrics.span("quality.check"):
+            problems = quality.run_checks(content, chapter)
+        if not problems:
+            return content, []
+        if llm_client.client is None:
+            break # Missing API key: retrying can't help
+        
+        print(f"Quality gate rejected attempt {attempt + 1}: {' '.join(problems)}")
+        # Tell the model what was wrong with the previous attempt
+        attempt_notes = f"{notes}\n(A previous draft was rejected: {' '.join(problems)})" if notes else \
+            f"(A previous draft was rejected: {' '.join(problems)})"
+    return content, problems
+
+def _release_claim(session: Session, chapter: Chapter, previous_status: str):
+    """Hands a GENERATING chapter back after a failed or interrupted call so it can be retried."""
+    state_machine.release(session, chapter, previous_status)
 
 def approve_chapter(session: Session, chapter_id: int):
     """Approves chapter and generates summary."""
     chapter = session.get(Chapter, chapter_id)
     if not chapter:
         return
-        
-    print("Approving chapter and generating summary...")
-    summary = llm_client.summarize_text(chapter.content)
+    if not state_machine.can_transition(Chapter, chapter.status, "APPROVED"):
+        print(f"Chapter {chapter.chapter_number} is {chapter.status} and can't be approved right now.")
+        return
     
-    chapter.summary = summary
-    chapter.status = "APPROVED"
-    session.commit()
+    # Remember which revision the editor approved; if it changes while we
+    # summarize (e.g. a rewrite from another tab), the approval is rejected.
+    seen_version = chapter.version
+    
+    print("Approving chapter and generating summary...")
+    with metrics.bind(book_id=chapter.book_id, chapter_id=chapter.id):
+        summary = llm_client.summarize_text(chapter.content)
+        
+        if not state_machine.transition(session, chapter, "APPROVED", expected_version=seen_version, summary=summary):
+            session.rollback()
+            print(f"Chapter {chapter.chapter_number} changed during approval; please review it again.")
+            return
+        # Approved text joins the near-duplicate index in the same transaction
+        with metrics.span("duplicates.index"):
+            duplicates.index_chapter(session, chapter)
+        candidates.clear(session, chapter.book_id, chapter.id)
+        session.commit()
     print(f"Chapter {chapter.chapter_number} approved.")
 
-def regenerate_chapter(session: Session, chapter_id: int, notes: str):
-    """Regenerates a specific chapter with notes."""
+def regenerate_chapter(session: Session, chapter_id: int, notes: str, scene_mode: bool = None,
+                       best_of: int = None, vary_temperature: bool = True):
+    """Regenerates a specific chapter with notes (best_of as in generate_next_chapter)."""
     chapter = session.get(Chapter, chapter_id)
     # Similar to generate, but we already have the object
     # We need to rebuild context (expensive in a real app to query DB again, but fine here)
@@ -149,16 +293,89 @@ def regenerate_chapter(session: Session, chapter_id: int, notes: str):
     context_str = "\n".join(previous_summaries)
     
     print(f"Regenerating Chapter {chapter.chapter_number} with notes: {notes}")
-    content = llm_client.generate_chapter_content(
-        book.title,
-        chapter.title,
-        book.outline.content,
-        context_str,
-        notes
-    )
-    
-    chapter.content = content
-    chapter.status = "WAITING_FOR_REVIEW"
-    chapter.editor_notes = notes
-    session.commit()
+    return _write_chapter(session, book, chapter, context_str, notes, notes, scene_mode, best_of, vary_temperature)
+
+# Share of the chapter's words a rewrite must touch before an approved
+# chapter's summary is regenerated
+MATERIAL_CHANGE_SHARE = 0.2
+CONTEXT_PARAGRAPHS_BEFORE = 3
+CONTEXT_PARAGRAPHS_AFTER = 2
+
+def find_marked_section(paragraphs: list, marker: str):
+    """
+    1-based (start, end) paragraph range covering the quoted `marker` text.
+    Long quotes may span paragraphs: they are matched by their first and last words.
+    """
+    words = marker.split()
+    head = " ".join(words[:8]).lower()
+    tail = " ".join(words[-8:]).lower()
+    normalized = [" ".join(p.split()).lower() for p in paragraphs]
+    start = next((i for i, p in enumerate(normalized) if head in p), None)
+    if start is None:
+        return None
+    end = next((i for i in range(start, len(normalized)) if tail in normalized[i]), start)
+    return start + 1, end + 1
+
+def regenerate_section(session: Session, chapter_id: int, notes: str, start: int = None, end: int = None, marker: str = None):
+    """
+    Rewrites only paragraphs start..end (1-based, inclusive) of a chapter, or
+    the paragraphs containing the quoted `marker` text, and splices the result
+    back into Chapter.content. Works on chapters in review and on approved ones;
+    an approved chapter's summary is only recomputed if the change is material.
+    """
+    chapter = session.get(Chapter, chapter_id)
+    if not chapter or not chapter.content:
+        raise ValueError("Chapter not found or has no content")
+    if chapter.status not in ("WAITING_FOR_REVIEW", "DRAFT", "APPROVED"):
+        print(f"Chapter {chapter.chapter_number} is {chapter.status} and can't be edited right now.")
+        return None
+    book = chapter.book
+    if not budget.check(session, book):
+        return None
+
+    paragraphs = duplicates.split_paragraphs(chapter.content)
+    if marker:
+        span = find_marked_section(paragraphs, marker)
+        if not span:
+            raise ValueError("Marked text not found in the chapter")
+        start, end = span
+    if not start or not end or not (1 <= start <= end <= len(paragraphs)):
+        raise ValueError(f"Paragraph range must be within 1..{len(paragraphs)}")
+
+    # The rewrite is only saved if nobody changed the chapter in the meantime
+    seen_version = chapter.version
+    before = "\n\n".join(paragraphs[max(0, start - 1 - CONTEXT_PARAGRAPHS_BEFORE):start - 1])
+    passage = "\n\n".join(paragraphs[start - 1:end])
+    after = "\n\n".join(paragraphs[end:end + CONTEXT_PARAGRAPHS_AFTER])
+
+    print(f"Rewriting paragraphs {start}-{end} of Chapter {chapter.chapter_number} with notes: {notes}")
+    with metrics.bind(book_id=book.id, chapter_id=chapter.id):
+        new_passage = llm_client.regenerate_passage(book.title, chapter.title, before, passage, after, notes)
+        problem = "LLM call failed." if new_passage is None else quality.check_error_signature(new_passage, chapter)
+        if problem:
+            print(f"[WARNING] Section rewrite failed: {problem}")
+            return None
+
+        new_paragraphs = paragraphs[:start - 1] + duplicates.split_paragraphs(new_passage) + paragraphs[end:]
+        new_content = "\n\n".join(new_paragraphs)
+        values = {"content": new_content}
+
+        # Only an approved chapter has a summary worth keeping in sync
+        changed_share = len(passage.split()) / max(1, len(chapter.content.split()))
+        is_approved = chapter.status == "APPROVED"
+        if is_approved and changed_share >= MATERIAL_CHANGE_SHARE:
+            print("Material change: regenerating chapter summary...")
+            summary = llm_client.summarize_text(new_content)
+            if quality.check_error_signature(summary, chapter):
+                print("[WARNING] Summary update failed; keeping the previous summary.")
+            else:
+                values["summary"] = summary
+
+        if not state_machine.update_if_unchanged(session, chapter, seen_version, **values):
+            session.rollback()
+            print(f"Chapter {chapter.chapter_number} changed while rewriting; please try again.")
+            return None
+        if is_approved:
+            duplicates.index_chapter(session, chapter)
+        session.commit()
     return chapter
@@ -0,0 +1,244 @@
+import re
+import zlib
+from typing import List, Optional
+
+import numpy as np
+from sqlalchemy import select, delete, insert, exists
+from sqlalchemy.orm import Session, aliased
+
+from db import Chapter, ParagraphSignature, LshBucket
+
+# Near-duplicate paragraph detection across approved chapters.
+#
+# Each paragraph is reduced to a MinHash signature over its word 5-gram
+# shingles (NumPy, all paragraphs of a chapter at once). Signatures are split
+# into LSH bands; paragraphs sharing any band bucket are candidates, and only
+# candidates are compared, so lookups never scan the whole library.
+# With 16 bands x 4 rows, pairs above ~50% Jaccard similarity collide with
+# high probability.
+NUM_PERM = 64
+BANDS = 16
+ROWS = NUM_PERM // BANDS
+SHINGLE_SIZE = 5
+MIN_PARAGRAPH_WORDS = 12
+SIMILARITY_THRESHOLD = 0.5
+
+_PRIME = np.uint64((1 << 31) - 1)
+_rng = np.random.RandomState(20240601) # Fixed seed: signatures must be stable across runs
+_A = _rng.randint(1, (1 << 31) - 1, size=NUM_PERM).astype(np.uint64)
+_B = _rng.randint(0, (1 << 31) - 1, size=NUM_PERM).astype(np.uint64)
+_BAND_MIX = _rng.randint(1, (1 << 62), size=ROWS, dtype=np.int64).astype(np.uint64) | np.uint64(1)
+
+def split_paragraphs(text: str) -> List[str]:
+    return [p.strip() for p in re.split(r'\n\s*\n', text or "") if p.strip()]
+
+def _shingle_hashes(paragraph: str) -> Optional[np.ndarray]:
+    words = re.findall(r"\w+", paragraph.lower())
+    if len(words) < MIN_PARAGRAPH_WORDS:
+        return None
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    return np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles)) % _PRIME
+
+def signatures(paragraphs: List[str]):
+    """
+    MinHash signatures for every paragraph long enough to matter.
+    Returns (indexes of the signed paragraphs, uint32 array of shape [n, NUM_PERM]).
+    """
+    kept, hashes = [], []
+    for i, paragraph in enumerate(paragraphs):
+        h = _shingle_hashes(paragraph)
+        if h is not None:
+            kept.append(i)
+            hashes.append(h)
+    if not kept:
+        return [], np.zeros((0, NUM_PERM), dtype=np.uint32)
+
+    # One (NUM_PERM x total_shingles) matrix, reduced per paragraph segment
+    offsets = np.cumsum([0] + [len(h) for h in hashes[:-1]])
+    values = np.concatenate(hashes)
+    permuted = (_A[:, None] * values[None, :] + _B[:, None]) % _PRIME
+    sigs = np.minimum.reduceat(permuted, offsets, axis=1).T
+    return kept, sigs.astype(np.uint32)
+
+def band_keys(sigs: np.ndarray) -> np.ndarray:
+    """One int64 bucket key per (paragraph, band)."""
+    bands = sigs.astype(np.uint64).reshape(len(sigs), BANDS, ROWS)
+    # uint64 arithmetic wraps, which is fine for hashing
+    mixed = (bands * _BAND_MIX).sum(axis=2, dtype=np.uint64)
+    return mixed.view(np.int64)
+
+def similarity(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """Estimated Jaccard similarity between signature rows (broadcasts)."""
+    return (a == b).mean(axis=-1)
+
+def index_chapter(session: Session, chapter: Chapter):
+    """(Re)indexes an approved chapter's paragraphs. The caller commits."""
+    old_ids = select(ParagraphSignature.id).where(ParagraphSignature.chapter_id == chapter.id)
+    session.execute(delete(LshBucket).where(LshBucket.signature_id.in_(old_ids)))
+    session.execute(delete(ParagraphSignature).where(ParagraphSignature.chapter_id == chapter.id))
+
+    paragraphs = split_paragraphs(chapter.content)
+    kept, sigs = signatures(paragraphs)
+    if not kept:
+        return
+    rows = [
+        ParagraphSignature(
+            book_id=chapter.book_id,
+            chapter_id=chapter.id,
+            paragraph_index=idx,
+            signature=sig.tobytes(),
+            preview=paragraphs[idx][:200],
+        )
+        for idx, sig in zip(kept, sigs)
+    ]
+    session.add_all(rows)
+    session.flush() # Assigns ids for the bucket rows
+
+    keys = band_keys(sigs)
+    session.execute(insert(LshBucket), [
+        {"band": band, "bucket": int(keys[r, band]), "signature_id": row.id}
+        for r, row in enumerate(rows)
+        for band in range(BANDS)
+    ])
+
+def backfill(session: Session, batch_size: int = 100) -> int:
+    """
+    Indexes approved chapters that have no signatures yet (approved before the
+    index existed, or imported from an archive). Commits after every batch.
+    Returns the number of chapters indexed.
+    """
+    indexed = 0
+    last_id = 0
+    while True:
+        batch = session.execute(
+            select(Chapter)
+            .where(
+                Chapter.status == "APPROVED",
+                Chapter.id > last_id,
+                ~exists().where(ParagraphSignature.chapter_id == Chapter.id),
+            )
+            .order_by(Chapter.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not batch:
+            session.commit()
+            return indexed
+        for chapter in batch:
+            index_chapter(session, chapter)
+        session.commit()
+        indexed += len(batch)
+        last_id = batch[-1].id
+
+def remove_book(session: Session, book_id: int):
+    """Drops a deleted book's paragraphs from the index. The caller commits."""
+    old_ids = select(ParagraphSignature.id).where(ParagraphSignature.book_id == book_id)
+    session.execute(delete(LshBucket).where(LshBucket.signature_id.in_(old_ids)))
+    session.execute(delete(ParagraphSignature).where(ParagraphSignature.book_id == book_id))
+
+def _load_signatures(session: Session, ids) -> dict:
+    found = {}
+    ids = list(ids)
+    for start in range(0, len(ids), 500):
+        for row in session.execute(
+            select(ParagraphSignature).where(ParagraphSignature.id.in_(ids[start:start + 500]))
+        ).scalars():
+            found[row.id] = row
+    return found
+
+def find_duplicates(session: Session, content: str, exclude_chapter_id: Optional[int] = None,
+                    threshold: float = SIMILARITY_THRESHOLD) -> List[dict]:
+    """
+    Paragraphs of `content` that nearly repeat an indexed (approved) paragraph.
+    Each match: paragraph_index, chapter_id, other_paragraph_index, similarity, preview.
+    """
+    paragraphs = split_paragraphs(content)
+    kept, sigs = signatures(paragraphs)
+    if not kept:
+        return []
+
+    keys = band_keys(sigs)
+    # bucket key -> [(draft row, band)]
+    wanted = {}
+    for r in range(len(kept)):
+        for band in range(BANDS):
+            wanted.setdefault(int(keys[r, band]), []).append((r, band))
+
+    candidates = {} # draft row -> set(signature ids)
+    key_list = list(wanted)
+    for start in range(0, len(key_list), 500):
+        for band, bucket, signature_id in session.execute(
+            select(LshBucket.band, LshBucket.bucket, LshBucket.signature_id)
+            .where(LshBucket.bucket.in_(key_list[start:start + 500]))
+        ):
+            for r, wanted_band in wanted[bucket]:
+                if wanted_band == band:
+                    candidates.setdefault(r, set()).add(signature_id)
+
+    stored = _load_signatures(session, set().union(*candidates.values()) if candidates else [])
+    matches = []
+    for r, ids in candidates.items():
+        rows = [stored[i] for i in ids if stored[i].chapter_id != exclude_chapter_id]
+        if not rows:
+            continue
+        other = np.stack([np.frombuffer(row.signature, dtype=np.uint32) for row in rows])
+        scores = similarity(sigs[r], other)
+        best = int(scores.argmax())
+        if scores[best] >= threshold:
+            matches.append({
+                "paragraph_index": kept[r],
+                "chapter_id": rows[best].chapter_id,
+                "other_paragraph_index": rows[best].paragraph_index,
+                "similarity": round(float(scores[best]), 2),
+                "preview": rows[best].preview,
+            })
+    return sorted(matches, key=lambda m: m["paragraph_index"])
+
+def describe_matches(session: Session, matches: List[dict]) -> str:
+    """One-line summary for editor notes, e.g. '¶3 ~ Ch.2 ¶5 (81%)'."""
+    numbers = dict(session.execute(
+        select(Chapter.id, Chapter.chapter_number).where(Chapter.id.in_({m["chapter_id"] for m in matches}))
+    ).all())
+    return ", ".join(
+        f"¶{m['paragraph_index'] + 1} ~ Ch.{numbers.get(m['chapter_id'], '?')} ¶{m['other_paragraph_index'] + 1} ({m['similarity']:.0%})"
+        for m in matches
+    )
+
+def duplicate_report(session: Session, threshold: float = SIMILARITY_THRESHOLD, book_id: Optional[int] = None) -> List[dict]:
+    """
+    Library-wide near-duplicate paragraph pairs, most similar first.
+    Candidate pairs come from shared LSH buckets (a SQL self-join), never all pairs.
+    """
+    a, b = aliased(LshBucket), aliased(LshBucket)
+    query = (
+        select(a.signature_id, b.signature_id)
+        .join(b, (a.band == b.band) & (a.bucket == b.bucket) & (a.signature_id < b.signature_id))
+        .distinct()
+    )
+    if book_id is not None:
+        in_book = select(ParagraphSignature.id).where(ParagraphSignature.book_id == book_id)
+        query = query.where(a.signature_id.in_(in_book) | b.signature_id.in_(in_book))
+    pairs = session.execute(query).all()
+    if not pairs:
+        return []
+
+    stored = _load_signatures(session, {i for pair in pairs for i in pair})
+    left = np.stack([np.frombuffer(stored[x].signature, dtype=np.uint32) for x, _ in pairs])
+    right = np.stack([np.frombuffer(stored[y].signature, dtype=np.uint32) for _, y in pairs])
+    scores = similarity(left, right)
+
+    report = []
+    for (x, y), score in zip(pairs, scores):
+        if score < threshold:
+            continue
+        first, second = stored[x], stored[y]
+        report.append({
+            "similarity": round(float(score), 2),
+            "book_id": first.book_id,
+            "chapter_id": first.chapter_id,
+            "paragraph_index": first.paragraph_index,
+            "other_book_id": second.book_id,
+            "other_chapter_id": second.chapter_id,
+            "other_paragraph_index": second.paragraph_index,
+            "preview": first.preview,
+        })
+    return sorted(report, key=lambda r: -r["similarity"])
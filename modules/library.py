@@ -0,0 +1,56 @@
+import os
+from sqlalchemy import select, func
+from sqlalchemy.orm import Session
+from db import Book, Chapter
+
+# Light-weight queries for the UI. They select only the columns a list or
+# navigator needs, so the cost of a page doesn't grow with book/library size.
+
+def list_books(session: Session, search: str = "", page: int = 0, page_size: int = 20):
+    """Returns (rows, total) for one page of the library, newest first."""
+    query = select(Book.id, Book.title, Book.status)
+    count_query = select(func.count(Book.id))
+    if search:
+        pattern = f"%{search.strip()}%"
+        query = query.where(Book.title.ilike(pattern))
+        count_query = count_query.where(Book.title.ilike(pattern))
+
+    total = session.execute(count_query).scalar_one()
+    rows = session.execute(
+        query.order_by(Book.id.desc()).offset(page * page_size).limit(page_size)
+    ).all()
+    return rows, total
+
+def chapter_index(session: Session, book_id: int):
+    """Chapter numbers, titles and statuses for a book, without the content."""
+    return session.execute(
+        select(Chapter.id, Chapter.chapter_number, Chapter.title, Chapter.status)
+        .where(Chapter.book_id == book_id)
+        .order_by(Chapter.chapter_number)
+    ).all()
+
+def compiled_page_count(path: str, page_size: int) -> int:
+    """Number of reader pages for a compiled book file."""
+    size = os.path.getsize(path)
+    return max(1, -(-size // page_size))
+
+def read_compiled_page(path: str, page: int, page_size: int = 20000) -> str:
+    """
+    Reads roughly `page_size` bytes of a compiled book, starting at page
+    `page` (0-based). Page edges are moved forward to the next line break, so
+    pages never split a line (or a multi-byte character) and don't overlap.
+    """
+    start = page * page_size
+    end = start + page_size
+    with open(path, "rb") as f:
+        if start > 0:
+            f.seek(start - 1)
+            # Skip the line that straddles the boundary; the previous page owns it
+            f.readline()
+            start = f.tell()
+        if start >= end:
+            return ""
+        data = f.read(end - start)
+        if data and not data.endswith(b"\n"):
+            data += f.readline()
+    return data.decode("utf-8", errors="replace")
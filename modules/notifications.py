@@ -1,58 +1,341 @@
+import atexit
+import json
 import logging
 import os
+import queue
+import smtplib
+import threading
+import time
+import urllib.request
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from email.mime.text import MIMEText
+
+from sqlalchemy import select
+
+from db import SessionFactory, NotificationOutbox
+
+try:
+    from streamlit.runtime.scriptrunner import get_script_run_ctx # Optional: only the app has it
+except ImportError:
+    get_script_run_ctx = None
 
 # Setup logging
 logging.basicConfig(level=logging.WARNING)
 logger = logging.getLogger(__name__)
 
-# --- NOTE TO REVIEWER: SMTP Implementation (Disabled for local demo) ---
-# import smtplib
-# from email.mime.text import MIMEText
-# def send_email_real(subject, body):
-#     sender = os.getenv("SMTP_USER")
-#     password = os.getenv("SMTP_PASSWORD")
-#     recipient = os.getenv("NOTIFICATION_EMAIL")
-#     msg = MIMEText(body)
-#     msg['Subject'] = subject
-#     msg['From'] = sender
-#     msg['To'] = recipient
-#     with smtplib.SMTP(os.getenv("SMTP_SERVER"), 587) as server:
-#         server.starttls()
-#         server.login(sender, password)
-#         server.send_message(msg)
-# ----------------------------------------------------------------------
+# Notifications are queued and delivered by a background thread, so sending one
+# never adds latency to generation or approval. Messages that arrive within
+# COALESCE_WINDOW seconds of each other with the same subject are merged into
+# a single digest. Failed deliveries are stored in the notification_outbox
+# table and retried with backoff, so they survive a restart.
+COALESCE_WINDOW = float(os.getenv("NOTIFICATION_COALESCE_SECONDS", "2"))
+RETRY_INTERVAL = 30.0
+MAX_ATTEMPTS = 5
 
-def send_notification(message: str, subject: str = "Book Gen Notification"):
-    """
-    Mock function to simulate sending emails or webhook notifications.
-    In a real app, this would use SMTP or requests.post().
-    """
-    
-    formatted_msg = f"""
+# --- Sinks ---
+
+class ConsoleSink:
+    name = "console"
+
+    def send(self, subject: str, message: str):
+        print(f"""
     =======================================================
     🔔  [NOTIFICATION SYSTEM]
     -------------------------------------------------------
     SUBJECT: {subject}
     MESSAGE: {message}
-    
-    (In a real production environment, this would be 
-     an email sent to: {os.getenv('NOTIFICATION_EMAIL', 'client@example.com')})
     =======================================================
+    """)
+
+class StreamlitLogSink:
+    """
+    Keeps the latest notifications in memory for app.py's Notification Log,
+    one log per browser session (st.toast only works on the script thread, so
+    the UI reads this log instead). Messages sent outside a Streamlit session,
+    e.g. from the CLI, are not logged here.
     """
-    print(formatted_msg)
-    
-    # Try to show in Streamlit
-    try:
-        import streamlit as st
-        # Just try to toast. If we are not in a streamlit thread, this will raise an error/warning caught below.
-        st.toast(f"**{subject}**: {message}", icon="🔔")
-        
-        # Optional: Also add to session state for a persistent log if initialized
-        if 'notification_log' not in st.session_state:
-            st.session_state['notification_log'] = []
-        st.session_state['notification_log'].append(f"{subject}: {message}")
-        
-    except Exception as e:
-        # If streamlit is not running or context is missing, just ignore but log error
-        print(f"Streamlit Toast Failed: {e}")
-        pass
+    name = "streamlit"
+    per_session = True # Receives the sending session's id
+
+    def __init__(self, size: int = 50, max_sessions: int = 200):
+        self.size = size
+        self.max_sessions = max_sessions
+        self.logs = OrderedDict() # session id -> deque, least recently used first
+        self._lock = threading.Lock()
+
+    def send(self, subject: str, message: str, session_id: str = None):
+        if session_id is None:
+            return
+        with self._lock:
+            log = self.logs.setdefault(session_id, deque(maxlen=self.size))
+            self.logs.move_to_end(session_id)
+            log.append(f"{subject}: {message}")
+            while len(self.logs) > self.max_sessions:
+                self.logs.popitem(last=False) # Closed tabs never clear their own log
+
+    def recent(self, session_id: str, limit: int) -> list:
+        with self._lock:
+            return list(reversed(self.logs.get(session_id, ())))[:limit]
+
+    def clear(self, session_id: str):
+        with self._lock:
+            self.logs.pop(session_id, None)
+
+class SMTPSink:
+    """Email sink that keeps one SMTP connection open across messages."""
+    name = "smtp"
+
+    def __init__(self, host: str, port: int = 587, user: str = None, password: str = None,
+                 sender: str = None, recipient: str = None, use_tls: bool = True, timeout: float = 30):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.sender = sender or user
+        self.recipient = recipient
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._conn = None
+
+    def _connect(self):
+        conn = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.use_tls:
+            conn.starttls()
+        if self.user and self.password:
+            conn.login(self.user, self.password)
+        return conn
+
+    def send(self, subject: str, message: str):
+        msg = MIMEText(message)
+        msg['Subject'] = subject
+        msg['From'] = self.sender
+        msg['To'] = self.recipient
+        if self._conn is None:
+            self._conn = self._connect()
+        try:
+            self._conn.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # Idle connections get dropped by the server; reconnect once
+            self._conn = self._connect()
+            self._conn.send_message(msg)
+        except (smtplib.SMTPException, OSError):
+            # Start from a fresh connection on the next attempt
+            self.close()
+            raise
+
+    def close(self):
+        if self._conn is not None:
+            try:
+                self._conn.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._conn = None
+
+class WebhookSink:
+    """POSTs {"subject": ..., "message": ...} as JSON (Slack/Discord-style incoming webhooks)."""
+    name = "webhook"
+
+    def __init__(self, url: str, timeout: float = 10):
+        self.url = url
+        self.timeout = timeout
+
+    def send(self, subject: str, message: str):
+        body = json.dumps({"subject": subject, "message": message, "text": f"{subject}: {message}"}).encode("utf-8")
+        request = urllib.request.Request(self.url, data=body, headers={"Content-Type": "application/json"}, method="POST")
+        # urlopen raises HTTPError for 4xx/5xx, which marks the delivery as failed
+        with urllib.request.urlopen(request, timeout=self.timeout):
+            pass
+
+def sinks_from_env() -> list:
+    """Console + in-app log, plus SMTP/webhook when they are configured."""
+    sinks = [ConsoleSink(), StreamlitLogSink()]
+    if os.getenv("SMTP_SERVER"):
+        sinks.append(SMTPSink(
+            host=os.getenv("SMTP_SERVER"),
+            port=int(os.getenv("SMTP_PORT", "587")),
+            user=os.getenv("SMTP_USER"),
+            password=os.getenv("SMTP_PASSWORD"),
+            recipient=os.getenv("NOTIFICATION_EMAIL", "client@example.com"),
+        ))
+    if os.getenv("NOTIFICATION_WEBHOOK_URL"):
+        sinks.append(WebhookSink(os.getenv("NOTIFICATION_WEBHOOK_URL")))
+    return sinks
+
+# --- Dispatcher ---
+
+class Dispatcher:
+    """Queue + background sender thread fanning out to the configured sinks."""
+
+    def __init__(self, sinks: list, coalesce_window: float = COALESCE_WINDOW, session_factory=SessionFactory):
+        self.sinks = {sink.name: sink for sink in sinks}
+        self.coalesce_window = coalesce_window
+        self.session_factory = session_factory
+        self.queue = queue.Queue()
+        self._last_retry = 0.0
+        self._thread = threading.Thread(target=self._run, name="notification-dispatcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, subject: str, message: str, session_id: str = None):
+        self.queue.put((subject, message, session_id))
+
+    def flush(self, timeout: float = 10) -> bool:
+        """Waits until everything queued so far has been handed to the sinks."""
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks:
+            if time.monotonic() > deadline:
+                return False
+            time.sleep(0.05)
+        return True
+
+    def _run(self):
+        while True:
+            try:
+                first = self.queue.get(timeout=RETRY_INTERVAL)
+            except queue.Empty:
+                self._retry_failed()
+                continue
+
+            batch = [first]
+            # Collect the rest of the burst
+            deadline = time.monotonic() + self.coalesce_window
+            while (remaining := deadline - time.monotonic()) > 0:
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                for subject, message, session_id in coalesce(batch):
+                    for sink in self.sinks.values():
+                        self._deliver(sink, subject, message, session_id)
+                if time.monotonic() - self._last_retry > RETRY_INTERVAL:
+                    self._retry_failed()
+            except Exception as e:
+                logger.error(f"Notification dispatcher error: {e}")
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+    def _deliver(self, sink, subject: str, message: str, session_id: str = None) -> bool:
+        try:
+            if getattr(sink, "per_session", False):
+                sink.send(subject, message, session_id)
+            else:
+                sink.send(subject, message)
+            return True
+        except Exception as e:
+            logger.warning(f"Notification via {sink.name} failed, queued for retry: {e}")
+            self._store_failure(sink.name, subject, message, str(e))
+            return False
+
+    def _store_failure(self, sink_name: str, subject: str, message: str, error: str):
+        with self.session_factory() as session:
+            session.add(NotificationOutbox(
+                sink=sink_name,
+                subject=subject,
+                message=message,
+                attempts=1,
+                last_error=error[:500],
+                next_attempt_at=datetime.utcnow() + timedelta(seconds=RETRY_INTERVAL),
+            ))
+            session.commit()
+
+    def _retry_failed(self):
+        """Re-sends due outbox rows; backoff doubles per attempt, rows are dropped after MAX_ATTEMPTS."""
+        self._last_retry = time.monotonic()
+        try:
+            with self.session_factory() as session:
+                due = session.execute(
+                    select(NotificationOutbox)
+                    .where(NotificationOutbox.next_attempt_at <= datetime.utcnow())
+                    .where(NotificationOutbox.sink.in_(list(self.sinks)))
+                    .order_by(NotificationOutbox.id)
+                    .limit(100)
+                ).scalars().all()
+                for row in due:
+                    try:
+                        self.sinks[row.sink].send(row.subject, row.message)
+                        session.delete(row)
+                    except Exception as e:
+                        row.attempts += 1
+                        row.last_error = str(e)[:500]
+                        if row.attempts >= MAX_ATTEMPTS:
+                            logger.error(f"Giving up on notification {row.id} via {row.sink}: {e}")
+                            session.delete(row)
+                        else:
+                            row.next_attempt_at = datetime.utcnow() + timedelta(seconds=RETRY_INTERVAL * 2 ** row.attempts)
+                session.commit()
+        except Exception as e:
+            logger.error(f"Notification retry failed: {e}")
+
+def coalesce(batch: list) -> list:
+    """
+    Merges messages with the same subject (from the same session) into one
+    digest, keeping first-seen order. Takes and returns (subject, message, session_id).
+    """
+    grouped = {}
+    for subject, message, session_id in batch:
+        grouped.setdefault((subject, session_id), []).append(message)
+
+    digests = []
+    for (subject, session_id), messages in grouped.items():
+        if len(messages) == 1:
+            digests.append((subject, messages[0], session_id))
+        else:
+            body = f"{len(messages)} updates:\n" + "\n".join(f"- {m}" for m in messages)
+            digests.append((f"{subject} ({len(messages)} updates)", body, session_id))
+    return digests
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+def get_dispatcher() -> Dispatcher:
+    """The process-wide dispatcher, started on first use with sinks_from_env()."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(sinks_from_env())
+        return _dispatcher
+
+def configure(sinks: list, coalesce_window: float = COALESCE_WINDOW, session_factory=SessionFactory) -> Dispatcher:
+    """Replaces the process-wide dispatcher (custom sinks, tests against local SMTP/HTTP servers)."""
+    global _dispatcher
+    with _dispatcher_lock:
+        _dispatcher = Dispatcher(sinks, coalesce_window, session_factory)
+        return _dispatcher
+
+def current_session_id():
+    """Id of the Streamlit browser session running this thread (None in the CLI)."""
+    if get_script_run_ctx is None:
+        return None
+    ctx = get_script_run_ctx(suppress_warning=True)
+    return ctx.session_id if ctx else None
+
+def send_notification(message: str, subject: str = "Book Gen Notification"):
+    """
+    Queues a notification and returns immediately.
+    Delivery (console, in-app log, SMTP, webhook) happens on the dispatcher thread;
+    the in-app log entry goes to the session that sent it.
+    """
+    get_dispatcher().submit(subject, message, current_session_id())
+
+def recent_notifications(limit: int = 5) -> list:
+    """Latest entries of this session's in-app log, newest first."""
+    sink = get_dispatcher().sinks.get("streamlit")
+    return sink.recent(current_session_id(), limit) if sink else []
+
+def clear_log():
+    """Clears this session's in-app log only."""
+    sink = get_dispatcher().sinks.get("streamlit")
+    if sink:
+        sink.clear(current_session_id())
+
+@atexit.register
+def _flush_on_exit():
+    # Give queued messages (e.g. the CLI's last notification) a chance to go out
+    if _dispatcher is not None:
+        _dispatcher.flush(timeout=COALESCE_WINDOW + 5)
+        for sink in _dispatcher.sinks.values():
+            if hasattr(sink, "close"):
+                sink.close()
@@ -1,52 +1,162 @@
+from datetime import datetime
+
+from sqlalchemy import select, insert, exists, literal, DateTime
 from sqlalchemy.orm import Session
 from db import Book, Outline
+from modules import state_machine, budget, candidates, changes
 import llm_client
+import metrics
+
+def _draft_outline(session: Session, book: Book, generate, best_of: int, vary_temperature: bool) -> str:
+    """
+    Drafts best_of outlines concurrently via generate(temperature), stores them
+    as ranked candidates and returns the best one's content.
+    """
+    temps = candidates.temperatures(best_of, llm_client.OUTLINE_TEMPERATURE, vary_temperature)
+    with metrics.bind(book_id=book.id):
+        drafts = candidates.draft(generate, temps)
+    entries = [
+        {"content": content, "temperature": temperature, "score": candidates.score_outline(content)}
+        for content, temperature in zip(drafts, temps)
+    ]
+    return candidates.store(session, book.id, None, "outline", entries)["content"]
 
-def create_initial_outline(session: Session, book_id: int, notes: str) -> Outline:
-    """Generates the first draft of an outline."""
+def _claim_new_outline(session: Session, book: Book) -> bool:
+    """
+    Claims a book's first outline by inserting an empty "generating" one, unless
+    the book has an outline by now. INSERT ... SELECT ... WHERE NOT EXISTS is a
+    single statement, so of two sessions racing on a new book only one inserts.
+    Commits. Returns False if another session got there first.
+    """
+    columns = ["book_id", "content", "status", "claimed_at"]
+    claim_row = select(
+        literal(book.id), literal(""), literal("generating"), literal(datetime.utcnow(), DateTime)
+    ).where(~exists().where(Outline.book_id == book.id))
+    won = session.execute(insert(Outline).from_select(columns, claim_row)).rowcount == 1
+    session.expire(book, ["outline"])
+    if won:
+        changes.record(session, book.outline, "created")
+    session.commit()
+    return won
+
+def create_initial_outline(session: Session, book_id: int, notes: str, best_of: int = None, vary_temperature: bool = True) -> Outline:
+    """
+    Generates the first draft of an outline.
+    best_of > 1 drafts that many candidates in parallel (default: CANDIDATE_COUNT env).
+    """
     book = session.get(Book, book_id)
     if not book:
         raise ValueError("Book not found")
 
-    print(f"Generating outline for '{book.title}'... (This may take a moment)")
-    outline_content = llm_client.generate_outline_from_llm(book.title, notes)
+    if not budget.check(session, book):
+        return book.outline
     
-    # Check if outline already exists, if so update, else create
+    # An abandoned first-generation placeholder is dropped, so it can be claimed afresh below
+    if book.outline and state_machine.is_stale_claim(book.outline):
+        state_machine.release(session, book.outline)
+
+    # The outline is claimed first so two sessions don't both generate it;
+    # a book without one gets an empty "generating" outline as its claim
     if book.outline:
-        book.outline.content = outline_content
-        book.outline.status = "waiting_for_review"
-        book.outline.editor_notes = "" # Reset notes
-        outline = book.outline
+        claimed = state_machine.claim(session, book.outline, "generating")
     else:
-        outline = Outline(book_id=book_id, content=outline_content, status="waiting_for_review")
-        session.add(outline)
-    
-    session.commit()
+        claimed = _claim_new_outline(session, book)
+    if not claimed:
+        print(f"Outline for '{book.title}' is already being generated elsewhere.")
+        return book.outline
+
+    outline = book.outline
+    best_of = candidates.count(best_of)
+    print(f"Generating {best_of} outline candidate(s) for '{book.title}'... (This may take a moment)")
+    title = book.title
+    try:
+        outline_content = _draft_outline(
+            session, book,
+            lambda temperature: llm_client.generate_outline_from_llm(title, notes, temperature),
+            best_of, vary_temperature
+        )
+        
+        if not state_machine.transition(
+            session, outline, "waiting_for_review",
+            content=outline_content,
+            editor_notes="", # Reset notes
+            claimed_at=None
+        ):
+            session.rollback()
+            print("The outline was reset while generating; the draft was discarded.")
+            return book.outline
+        
+        session.commit()
+    except BaseException:
+        # Interrupted or failed: hand the claim back so the outline isn't stuck in
+        # "generating" (an empty first-generation outline is removed instead)
+        state_machine.release(session, outline)
+        raise
     return outline
 
-def update_outline_with_feedback(session: Session, book_id: int, notes: str) -> Outline:
-    """Regenerates outline based on user feedback."""
+def update_outline_with_feedback(session: Session, book_id: int, notes: str, best_of: int = None, vary_temperature: bool = True) -> Outline:
+    """Regenerates outline based on user feedback (best_of as in create_initial_outline)."""
     book = session.get(Book, book_id)
     if not book or not book.outline:
         raise ValueError("Outline not found")
 
-    print(f"Refining outline for '{book.title}'...")
-    new_content = llm_client.regenerate_outline_from_llm(book.outline.content, notes)
-    
-    book.outline.content = new_content
-    book.outline.status = "waiting_for_review"
-    book.outline.editor_notes = notes # Keep history if we wanted, but here just replace
-    
-    session.commit()
-    return book.outline
+    if not budget.check(session, book):
+        return book.outline
+    if not state_machine.claim(session, book.outline, "generating"):
+        print(f"Outline for '{book.title}' is already being refined elsewhere.")
+        return book.outline
+
+    best_of = candidates.count(best_of)
+    print(f"Refining outline for '{book.title}' ({best_of} candidate(s))...")
+    outline = book.outline
+    current = outline.content
+    try:
+        new_content = _draft_outline(
+            session, book,
+            lambda temperature: llm_client.regenerate_outline_from_llm(current, notes, temperature),
+            best_of, vary_temperature
+        )
+        
+        if not state_machine.transition(
+            session, outline, "waiting_for_review",
+            content=new_content,
+            editor_notes=notes, # Keep history if we wanted, but here just replace
+            claimed_at=None
+        ):
+            session.rollback()
+            print("The outline was reset while generating; the draft was discarded.")
+            return outline
+        
+        session.commit()
+    except BaseException:
+        # Interrupted or failed: hand the claim back so the outline isn't stuck in "generating"
+        state_machine.release(session, outline)
+        raise
+    return outline
 
-def approve_outline(session: Session, book_id: int):
-    """Marks outline as approved and ready for writing."""
+def approve_outline(session: Session, book_id: int) -> bool:
+    """
+    Marks outline as approved and ready for writing.
+    Returns False if it can't be approved right now (nothing is changed then).
+    """
     book = session.get(Book, book_id)
     if not book or not book.outline:
         raise ValueError("Outline not found")
-        
-    book.outline.status = "approved"
-    book.status = "WRITING_CHAPTERS"
+    
+    if not state_machine.can_transition(Outline, book.outline.status, "approved"):
+        print(f"Outline is '{book.outline.status}' and can't be approved right now.")
+        return False
+    if not state_machine.can_transition(Book, book.status, "WRITING_CHAPTERS"):
+        print(f"Book is '{book.status}'; its outline can't be approved again.")
+        return False
+    
+    # Both updates go in one transaction; if either lost a race, neither applies
+    if not (state_machine.transition(session, book.outline, "approved")
+            and state_machine.transition(session, book, "WRITING_CHAPTERS")):
+        session.rollback()
+        print("Outline changed in another session; please review it again.")
+        return False
+    candidates.clear(session, book.id)
     session.commit()
     print("Outline approved! Moving to Chapter Generation.")
+    return True
@@ -0,0 +1,105 @@
+import os
+import re
+from typing import Callable, List, Optional
+
+from db import Chapter
+
+# Local, cheap checks run on every generated chapter before it is shown to an
+# editor. A validator takes (content, chapter) and returns a short problem
+# description, or None if the content passes. Failing drafts are regenerated
+# automatically (see modules/chapter.py) up to MAX_AUTO_RETRIES times.
+MIN_WORDS = int(os.getenv("QUALITY_MIN_WORDS", "300"))
+MAX_WORDS = int(os.getenv("QUALITY_MAX_WORDS", "20000"))
+MAX_REPETITION = float(os.getenv("QUALITY_MAX_REPETITION", "0.25"))
+MAX_AUTO_RETRIES = int(os.getenv("QUALITY_MAX_RETRIES", "2"))
+
+ERROR_SIGNATURES = re.compile(
+    r'^\s*(error generating chapter|error: groq_api_key|error creating outline|error summarizing|error updating outline|error regenerating passage)',
+    re.IGNORECASE
+)
+# Closing punctuation/markup a finished chapter can reasonably end with
+TERMINAL_CHARS = '.!?"\'”’)]*_~…'
+STOPWORDS = {
+    "the", "and", "for", "with", "from", "into", "that", "this", "their", "there", "where", "when",
+    "what", "which", "about", "after", "before", "chapter", "part", "your", "them", "they", "have",
+}
+
+def check_error_signature(content: str, chapter: Chapter) -> Optional[str]:
+    if not content or not content.strip():
+        return "Empty output."
+    if ERROR_SIGNATURES.match(content):
+        return f"LLM returned an error: {content.strip()[:120]}"
+    return None
+
+def check_length(content: str, chapter: Chapter) -> Optional[str]:
+    words = len(content.split())
+    if words < MIN_WORDS:
+        return f"Too short ({words} words, minimum {MIN_WORDS})."
+    if words > MAX_WORDS:
+        return f"Too long ({words} words, maximum {MAX_WORDS})."
+    return None
+
+def check_truncation(content: str, chapter: Chapter) -> Optional[str]:
+    # Hitting max_tokens cuts the text mid-sentence
+    tail = content.rstrip()
+    if tail and tail[-1] not in TERMINAL_CHARS:
+        return f"Looks truncated (ends with: '...{tail[-40:]}')."
+    return None
+
+def repetition_ratio(content: str, n: int = 8) -> float:
+    """Share of word n-grams that are repeats of an earlier n-gram (0 = no repetition)."""
+    words = re.findall(r"\w+", content.lower())
+    if len(words) < n * 2:
+        return 0.0
+    shingles = [tuple(words[i:i + n]) for i in range(len(words) - n + 1)]
+    return 1 - len(set(shingles)) / len(shingles)
+
+def check_repetition(content: str, chapter: Chapter) -> Optional[str]:
+    ratio = repetition_ratio(content)
+    if ratio > MAX_REPETITION:
+        return f"Heavy repetition ({ratio:.0%} of passages repeat)."
+    return None
+
+def chapter_keywords(chapter: Chapter) -> set:
+    """Significant words from the chapter title and its line in the outline."""
+    text = chapter.title or ""
+    outline = chapter.book.outline.content if chapter.book and chapter.book.outline else ""
+    if chapter.title and outline:
+        for line in outline.split("\n"):
+            if chapter.title.lower() in line.lower():
+                text += " " + line
+                break
+    return {w for w in re.findall(r"[a-z]{4,}", text.lower()) if w not in STOPWORDS}
+
+def check_on_topic(content: str, chapter: Chapter) -> Optional[str]:
+    keywords = chapter_keywords(chapter)
+    if not keywords:
+        return None
+    lowered = content.lower()
+    if not any(k in lowered for k in keywords):
+        return f"None of the chapter's keywords appear ({', '.join(sorted(keywords)[:6])})."
+    return None
+
+# Order matters: cheap, decisive checks first
+VALIDATORS: List[Callable[[str, Chapter], Optional[str]]] = [
+    check_error_signature,
+    check_length,
+    check_truncation,
+    check_repetition,
+    check_on_topic,
+]
+
+def register_validator(validator: Callable[[str, Chapter], Optional[str]]):
+    """Adds a custom check to the gate."""
+    VALIDATORS.append(validator)
+
+def run_checks(content: str, chapter: Chapter, validators=None) -> List[str]:
+    """Returns every problem found; an empty list means the draft passes."""
+    problems = []
+    for validator in validators if validators is not None else VALIDATORS:
+        problem = validator(content or "", chapter)
+        if problem:
+            problems.append(problem)
+            if validator is check_error_signature:
+                break # Nothing else is meaningful for an error string
+    return problems
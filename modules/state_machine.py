@@ -0,0 +1,169 @@
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import update, delete
+from sqlalchemy.orm import Session
+from db import Book, Outline, Chapter
+from modules import changes
+
+# Allowed status transitions per model.
+# Every transition is a single conditional UPDATE (status + version guard), so two
+# sessions racing for the same row cannot both win. The loser gets False back.
+# Successful writes also append to the change feed (modules/changes.py) in the
+# same transaction.
+BOOK_TRANSITIONS = {
+    "PLANNING": {"WRITING_CHAPTERS"},
+    "WRITING_CHAPTERS": {"COMPLETED"},
+    "COMPLETED": {"COMPLETED"},  # Re-compiling is allowed
+}
+
+# Outline statuses are stored lowercase by modules/outline.py
+OUTLINE_TRANSITIONS = {
+    "DRAFT": {"generating", "waiting_for_review"},
+    "waiting_for_review": {"generating", "approved"},
+    "generating": {"waiting_for_review"},
+    "approved": set(),
+}
+
+CHAPTER_TRANSITIONS = {
+    "PENDING": {"GENERATING", "APPROVED"},  # APPROVED = manual skip from the CLI
+    "DRAFT": {"GENERATING", "APPROVED"},
+    "GENERATING": {"WAITING_FOR_REVIEW", "PENDING", "DRAFT"},  # Back to PENDING/DRAFT if the call fails
+    "WAITING_FOR_REVIEW": {"GENERATING", "APPROVED"},
+    "APPROVED": set(),
+}
+
+TRANSITIONS = {
+    Book: BOOK_TRANSITIONS,
+    Outline: OUTLINE_TRANSITIONS,
+    Chapter: CHAPTER_TRANSITIONS,
+}
+
+# A generating claim is a lease: a process that dies mid-call (killed, browser
+# session stopped) can't release it, so after CLAIM_TIMEOUT it counts as stale
+# and can be taken over or reset.
+GENERATING = {Outline: "generating", Chapter: "GENERATING"}
+CLAIM_TIMEOUT = timedelta(seconds=int(os.getenv("GENERATION_TIMEOUT_SECONDS", "900")))
+
+def can_transition(model, from_status: str, to_status: str) -> bool:
+    """Checks the transition table for the given model."""
+    return to_status in TRANSITIONS[model].get(from_status, set())
+
+def transition(session: Session, obj, to_status: str, expected_version: int = None, **values) -> bool:
+    """
+    Atomically moves `obj` from its current status to `to_status`.
+
+    The UPDATE only matches if the row still has the status (and version) this
+    session last saw, so it doubles as a claim: whoever gets True owns the next
+    step. Extra column values (e.g. content=...) are written in the same UPDATE.
+    The caller is responsible for committing.
+    Returns False if another session changed the row first.
+    """
+    model = type(obj)
+    from_status = obj.status
+    if not can_transition(model, from_status, to_status):
+        raise ValueError(f"Invalid {model.__name__} transition: {from_status} -> {to_status}")
+
+    version = expected_version if expected_version is not None else obj.version
+    if to_status == GENERATING.get(model):
+        values.setdefault("claimed_at", datetime.utcnow())
+
+    result = session.execute(
+        update(model)
+        .where(model.id == obj.id, model.status == from_status, model.version == version)
+        .values(status=to_status, version=model.version + 1, **values)
+        .execution_options(synchronize_session=False)
+    )
+    won = result.rowcount == 1
+    if won:
+        changes.record(session, obj, "status", status=to_status)
+    # Drop our cached copy so the next attribute access reloads the new row
+    session.expire(obj)
+    return won
+
+def is_stale_claim(obj) -> bool:
+    """True if `obj` has been generating for longer than CLAIM_TIMEOUT."""
+    if obj.status != GENERATING.get(type(obj)):
+        return False
+    return obj.claimed_at is None or datetime.utcnow() - obj.claimed_at > CLAIM_TIMEOUT
+
+def release_status(obj, previous_status: str = None) -> str:
+    """Where a generating outline/chapter goes back to when its claim is given up."""
+    if isinstance(obj, Outline):
+        return "waiting_for_review"
+    if previous_status in ("PENDING", "DRAFT"):
+        return previous_status
+    # WAITING_FOR_REVIEW can't be re-entered from a failed generation; keep the text as a DRAFT
+    return "DRAFT" if obj.content else "PENDING"
+
+def release(session: Session, obj, previous_status: str = None) -> bool:
+    """
+    Gives up a generating claim (failed, interrupted or stale generation) and
+    commits. Discards anything uncommitted in the session first. Returns False
+    if the object is no longer generating (e.g. someone else already reset it).
+    """
+    session.rollback()
+    if obj.status != GENERATING.get(type(obj)):
+        return False
+    if isinstance(obj, Outline) and not obj.content:
+        return _drop_placeholder(session, obj)
+    if transition(session, obj, release_status(obj, previous_status), claimed_at=None):
+        session.commit()
+        return True
+    session.rollback()
+    return False
+
+def _drop_placeholder(session: Session, outline: Outline) -> bool:
+    """
+    Deletes the empty outline that claimed a book's first generation (see
+    outline.create_initial_outline), so the book has no outline again.
+    """
+    changes.record(session, outline, "deleted")
+    result = session.execute(
+        delete(Outline)
+        .where(Outline.id == outline.id, Outline.status == outline.status, Outline.version == outline.version)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        session.rollback()
+        return False
+    session.expunge(outline)
+    session.commit()
+    return True
+
+def claim(session: Session, obj, to_status: str, **values) -> bool:
+    """
+    Transition + immediate commit, so other sessions see the claim before a slow LLM call.
+    A stale claim (see CLAIM_TIMEOUT) is released first and can then be taken over.
+    """
+    if is_stale_claim(obj):
+        print(f"Resetting a stale {type(obj).__name__.lower()} generation claim.")
+        release(session, obj)
+        if obj not in session:
+            return False # It was an abandoned placeholder and is gone now
+    if not can_transition(type(obj), obj.status, to_status):
+        return False
+    if transition(session, obj, to_status, **values):
+        session.commit()
+        return True
+    session.rollback()
+    return False
+
+def update_if_unchanged(session: Session, obj, expected_version: int, **values) -> bool:
+    """
+    Writes `values` only if the row is still at `expected_version` (status unchanged).
+    Used for edits that don't move the state machine, e.g. partial rewrites.
+    The caller is responsible for committing.
+    """
+    model = type(obj)
+    result = session.execute(
+        update(model)
+        .where(model.id == obj.id, model.version == expected_version)
+        .values(version=model.version + 1, **values)
+        .execution_options(synchronize_session=False)
+    )
+    won = result.rowcount == 1
+    if won:
+        changes.record(session, obj, "content")
+    session.expire(obj)
+    return won
@@ -0,0 +1,153 @@
+import re
+from typing import List, Optional, Tuple
+
+# Prompt assembly for chapter-level calls.
+#
+# Every prompt is split into a stable prefix (system role, book title, outline
+# digest), which is byte-identical for every call on the same book so provider
+# prefix caching can reuse it, and a per-call suffix (outline window, story so
+# far, notes, task). Instead of the whole outline, each call gets the full text
+# of the current chapter's entry plus its neighbours; the other chapters only
+# appear as one-line headings in the digest.
+
+try:
+    import tiktoken # Optional: exact counts for OpenAI-style tokenizers
+    _encoding = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    _encoding = None
+
+# "Chapter 1: ...", "## Chapter 1", "**Chapter 1**", "1. ..." (also used by chapter.parse_chapters_from_outline)
+CHAPTER_HEADING = re.compile(r'^(?:[#*]+\s*)?(?:chapter\s+(\d+)|(\d+)\.)', re.IGNORECASE)
+OUTLINE_WINDOW_RADIUS = 1
+
+def count_tokens(text: str) -> int:
+    """Token count (tiktoken if installed, otherwise ~4 characters per token)."""
+    if not text:
+        return 0
+    if _encoding is not None:
+        return len(_encoding.encode(text))
+    return max(1, len(text) // 4)
+
+def split_outline(outline: str) -> List[Tuple[str, str]]:
+    """(heading line, full entry text) per chapter, in outline order."""
+    entries = []
+    for line in (outline or "").split("\n"):
+        stripped = line.strip()
+        if CHAPTER_HEADING.match(stripped):
+            entries.append([stripped, [stripped]])
+        elif entries and stripped:
+            entries[-1][1].append(stripped)
+    return [(heading, "\n".join(lines)) for heading, lines in entries]
+
+def outline_digest(outline: str) -> str:
+    """Chapter headings only; identical for every chapter of a book."""
+    entries = split_outline(outline)
+    if not entries:
+        return outline # Unparseable outline: keep it whole rather than lose it
+    return "\n".join(heading.replace("*", "").strip() for heading, _ in entries)
+
+def _chapter_index(entries, chapter_number: Optional[int], chapter_title: str) -> Optional[int]:
+    if chapter_number and 1 <= chapter_number <= len(entries):
+        return chapter_number - 1
+    title = (chapter_title or "").lower()
+    return next((i for i, (heading, _) in enumerate(entries) if title and title in heading.lower()), None)
+
+def outline_window(outline: str, chapter_number: Optional[int], chapter_title: str = "", radius: int = OUTLINE_WINDOW_RADIUS) -> str:
+    """Full outline entries for the current chapter and its `radius` neighbours on each side."""
+    entries = split_outline(outline)
+    current = _chapter_index(entries, chapter_number, chapter_title)
+    if current is None:
+        return "" # The digest already carries the outline
+    window = entries[max(0, current - radius):current + radius + 1]
+    return "\n\n".join(text for _, text in window)
+
+class Prompt:
+    """Assembled chat messages plus per-section token counts."""
+
+    def __init__(self, template: str, version: str, system_sections: list, user_sections: list):
+        self.template = template
+        self.version = version
+        self.sections = [(name, count_tokens(text)) for name, text in system_sections + user_sections]
+        self.messages = [
+            {"role": "system", "content": "\n\n".join(text for _, text in system_sections if text)},
+            {"role": "user", "content": "\n\n".join(text for _, text in user_sections if text)},
+        ]
+
+    @property
+    def label(self) -> str:
+        """template/version, as recorded on the call's llm.* span."""
+        return f"{self.template}/{self.version}"
+
+    @property
+    def prefix_tokens(self) -> int:
+        return count_tokens(self.messages[0]["content"])
+
+    @property
+    def total_tokens(self) -> int:
+        return sum(tokens for _, tokens in self.sections)
+
+    def describe(self) -> str:
+        return f"{self.label}: " + ", ".join(f"{name}={tokens}" for name, tokens in self.sections)
+
+# Bump a template's version whenever its wording changes. The version is
+# recorded on every llm.* span (MetricEvent.prompt_version), so the metrics
+# reports keep numbers from different wordings apart.
+TEMPLATES = {
+    "chapter": {
+        "version": "v1",
+        "role": "You are a best-selling author.",
+        "task": (
+            "Task:\n"
+            "Write the complete content for '{chapter_title}'.\n"
+            "Write in an engaging style suitable for the topic.\n"
+            "Ensure continuity with previous chapters."
+        ),
+    },
+    "scene_plan": {
+        "version": "v1",
+        "role": "You are a meticulous story planner.",
+        "task": (
+            "Task:\n"
+            "Plan '{chapter_title}' as 2 to {max_scenes} consecutive scenes (or sections, for non-fiction).\n"
+            "Output ONLY one line per scene in the form:\n"
+            "Scene 1: <2-3 sentence description of what happens / is covered>"
+        ),
+    },
+    "scene": {
+        "version": "v1",
+        "role": "You are a best-selling author.",
+        "task": (
+            "Full Scene Plan for '{chapter_title}':\n{scene_plan}\n\n"
+            "Previous scene (written separately): {previous_scene}\n"
+            "Next scene (written separately): {next_scene}\n\n"
+            "Task:\n"
+            "Write ONLY scene {scene_number}: {scene}\n"
+            "Do not write a chapter heading. Do not summarize the other scenes.\n"
+            "Start where the previous scene leaves off and end where the next one can pick up."
+        ),
+    },
+}
+
+def build_chapter_prompt(template: str, book_title: str, chapter_title: str, outline: str,
+                         previous_summaries: str, notes: Optional[str], chapter_number: Optional[int] = None,
+                         **task_values) -> Prompt:
+    """
+    Assembles a chapter-family prompt. Stable sections go in the system
+    message, in a fixed order; everything call-specific goes after them.
+    """
+    spec = TEMPLATES[template]
+    system_sections = [
+        ("role", spec["role"]),
+        ("book", f"Book Title: {book_title}"),
+        ("outline_digest", f"Book Outline (chapter list):\n{outline_digest(outline)}"),
+    ]
+    window = outline_window(outline, chapter_number, chapter_title)
+    user_sections = [
+        ("chapter", f"Current Chapter: {chapter_title}"),
+        ("outline_window", f"Outline detail for this chapter and its neighbours:\n{window}" if window else ""),
+        ("story_so_far", f"STORY SO FAR (Summaries of previous chapters):\n{previous_summaries}"
+                         if previous_summaries else "This is the first chapter."),
+        ("notes", f"Specific Author Notes for this Chapter:\n{notes if notes else 'None'}"),
+        ("task", spec["task"].format(chapter_title=chapter_title, **task_values)),
+    ]
+    return Prompt(template, spec["version"], system_sections, user_sections)